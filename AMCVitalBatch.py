@@ -0,0 +1,116 @@
+import os
+import re
+import csv
+import sys
+import time
+import argparse
+import datetime
+import concurrent.futures
+import numpy as np
+import AMCVitalReader as vr
+
+# A manifest is a CSV file with the columns file, device, track, start, end and label. start and
+# end are local wall-clock times such as 2018-04-25 08:03:52; leave both empty to take the whole track.
+def read_manifest(filename):
+    jobs = []
+    with open(filename, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            jobs.append({'job': len(jobs), 'file': row['file'], 'device': row.get('device') or '',
+                         'track': row['track'], 'start': row.get('start') or '', 'end': row.get('end') or '',
+                         'label': row.get('label') or ''})
+    return jobs
+
+def group_jobs(jobs):
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job['file'], []).append(job)
+    return groups
+
+def output_name(job, fmt):
+    name = '%05d_%s_%s_%s' % (job['job'], os.path.splitext(os.path.basename(job['file']))[0], job['track'], job['label'])
+    return re.sub(r'[^\w.-]+', '_', name).strip('_') + '.' + fmt
+
+def write_output(filename, trackname, dt, val, fmt):
+    if fmt == 'npz':
+        np.savez(filename, time=dt, value=val)
+        return
+    with open(filename, 'w', newline='') as csvfile:
+        csvfile.write('Time,%s\n' % trackname)
+        np.savetxt(csvfile, np.column_stack([np.datetime_as_string(dt), np.asarray(val).astype(str)]), fmt='%s', delimiter=',')
+
+def extract(reader, job):
+    t_track = reader.read_track(job['device'], job['track'])
+    if job['start'] or job['end']:
+        start = datetime.datetime.fromisoformat(job['start'])
+        end = datetime.datetime.fromisoformat(job['end'])
+        if t_track.rec_type == 2:
+            return reader.read_number_datetime_interval(job['device'], job['track'], start, end)
+        return reader.read_wave_datetime_interval(job['device'], job['track'], start, end)
+    if t_track.rec_type == 2:
+        return reader.read_number_datetime(job['device'], job['track'])
+    return reader.read_wave_datetime(job['device'], job['track'])
+
+# Decodes one file once for all of its jobs. Errors are reported per job (or for the whole
+# file when it cannot be parsed) instead of stopping the batch.
+def run_file(filename, jobs, out_dir, fmt):
+    results = []
+    try:
+        reader = vr.vital_reader(filename)
+        reader.read_header()
+        reader.read_packets(tracks=list(set((job['device'], job['track']) for job in jobs)), store_records=False)
+    except Exception as e:
+        return [dict(job, output='', samples=0, error='%s: %s' % (type(e).__name__, e)) for job in jobs]
+    for job in jobs:
+        try:
+            dt, val = extract(reader, job)
+            output = os.path.join(out_dir, output_name(job, fmt))
+            write_output(output, job['track'], dt, val, fmt)
+            results.append(dict(job, output=output, samples=len(val), error=''))
+        except Exception as e:
+            results.append(dict(job, output='', samples=0, error='%s: %s' % (type(e).__name__, e)))
+    return results
+
+def run_batch(jobs, out_dir, workers=None, fmt='csv', progress=True):
+    os.makedirs(out_dir, exist_ok=True)
+    groups = group_jobs(jobs)
+    results = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_file, filename, groups[filename], out_dir, fmt): filename for filename in groups}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            try:
+                file_results = future.result()
+            except Exception as e:  # the worker itself died
+                file_results = [dict(job, output='', samples=0, error='%s: %s' % (type(e).__name__, e)) for job in groups[futures[future]]]
+            results.extend(file_results)
+            if progress:
+                failed = sum(1 for r in file_results if r['error'])
+                print('[%d/%d] %.1fs %s : %d jobs, %d failed' % (done, len(groups), time.perf_counter() - start,
+                                                                 futures[future], len(file_results), failed))
+    results.sort(key=lambda r: r['job'])
+    return results
+
+def write_report(filename, results):
+    fieldnames = ['job', 'file', 'device', 'track', 'start', 'end', 'label', 'output', 'samples', 'error']
+    with open(filename, 'w', newline='') as csvfile:
+        csv_writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writeheader()
+        csv_writer.writerows(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract track intervals from many .vital files in parallel.')
+    parser.add_argument('manifest', help='CSV with the columns file, device, track, start, end, label')
+    parser.add_argument('out_dir', help='directory for the per-job output files and report.csv')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('-f', '--format', choices=['csv', 'npz'], default='csv')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print progress')
+    args = parser.parse_args(argv)
+
+    results = run_batch(read_manifest(args.manifest), args.out_dir, args.workers, args.format, not args.quiet)
+    write_report(os.path.join(args.out_dir, 'report.csv'), results)
+    failed = sum(1 for r in results if r['error'])
+    print('%d jobs, %d failed' % (len(results), failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
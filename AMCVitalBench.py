@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import statistics
+import importlib.util
+import concurrent.futures
+import multiprocessing
+import numpy as np
+import AMCVitalWriter as vw
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Benchmarks a version of AMCVitalReader.py (by default the one next to this file) on synthetic
+# files of several durations. Every case runs in a fresh process so that peak RSS belongs to it
+# alone; results can be saved as JSON and compared with a previous run.
+default_reader = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AMCVitalReader.py')
+
+def make_file(directory, duration, seed=0):
+    filename = os.path.join(directory, 'bench_%d_%d.vital' % (duration, seed))
+    if not os.path.exists(filename):
+        vw.synthesize(filename + '.tmp', duration, gaps=[(duration // 3, 2)], seed=seed)
+        os.replace(filename + '.tmp', filename)
+    return filename
+
+def load_reader(path):
+    spec = importlib.util.spec_from_file_location('bench_reader', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # bytes on macOS, KiB on Linux
+
+def timed(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+# One case, run in a worker process: parse the whole file, then time the query methods on it.
+def run_case(reader_path, filename, repeat=5, window=30.0, seed=0):
+    vr = load_reader(reader_path)
+    start = time.perf_counter()
+    reader = vr.vital_reader(filename)
+    reader.read_header()
+    reader.read_packets()
+    parse = time.perf_counter() - start
+    rss = peak_rss()
+
+    samples = 0
+    uncompressed = 0
+    for t_track in reader.track.values():
+        if t_track.rec_type == 1 or t_track.rec_type == 6:
+            # raw holds the samples as stored; older readers (-r) only have the v_wave list
+            n = len(t_track.raw) if hasattr(t_track, 'raw') else len(t_track.v_wave)
+            samples += n
+            uncompressed += len(t_track.dt) * 20 + n * (4 if t_track.rec_fmt == 1 else 2)
+        else:
+            samples += len(t_track.v_number)
+    volt = [t for t in reader.track.values() if t.name == b'VOLT'][0]
+    t_first = float(volt.dt[0])
+    t_last = float(volt.dt[-1])
+    rnd = np.random.default_rng(seed)
+    starts = [datetime.datetime.fromtimestamp(t) for t in rnd.uniform(t_first, max(t_first, t_last - window), repeat)]
+    intervals = []
+    for s in starts:
+        begin = time.perf_counter()
+        reader.read_wave_datetime_interval('DI-1120', 'VOLT', s, s + datetime.timedelta(seconds=window))
+        intervals.append(time.perf_counter() - begin)
+    size = os.path.getsize(filename)
+    return {'file': os.path.basename(filename), 'bytes': size, 'samples': samples, 'parse_s': parse,
+            'mb_per_s': size / parse / 1e6, 'uncompressed_mb_per_s': uncompressed / parse / 1e6,
+            'samples_per_s': samples / parse, 'peak_rss_mb': rss / 1e6 if rss is not None else None,
+            'interval_ms': statistics.median(intervals) * 1000,
+            'read_wave_ms': timed(lambda: reader.read_wave('DI-1120', 'VOLT'), repeat) * 1000,
+            'check_validity_ms': timed(reader.check_validity, max(1, repeat // 5)) * 1000}
+
+def run_benchmark(reader_path=default_reader, durations=(600, 3600), directory='vital_bench', repeat=5):
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for duration in durations:
+        filename = make_file(directory, duration)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, os.path.abspath(reader_path), filename, repeat).result()
+        result['duration'] = duration
+        results.append(result)
+    return {'reader': os.path.abspath(reader_path), 'results': results}
+
+columns = ['duration', 'bytes', 'samples', 'parse_s', 'mb_per_s', 'samples_per_s', 'peak_rss_mb',
+           'interval_ms', 'read_wave_ms', 'check_validity_ms']
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
+
+# Prints one row per duration; with a baseline, every column after samples also shows
+# baseline / current for the times and current / baseline for the rates (so > 1 is faster).
+def report(run, baseline=None):
+    rows = [columns]
+    base = {r['duration']: r for r in baseline['results']} if baseline else {}
+    for r in run['results']:
+        row = [format_value(r[c]) for c in columns]
+        b = base.get(r['duration'])
+        if b:
+            for i, c in enumerate(columns):
+                if i < 3 or r[c] is None or b.get(c) is None or not r[c] or not b[c]:
+                    continue
+                ratio = r[c] / b[c] if c.endswith('_per_s') else b[c] / r[c]
+                row[i] += ' (%.2fx)' % ratio
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark AMCVitalReader on synthetic .vital files.')
+    parser.add_argument('-r', '--reader', default=default_reader, help='AMCVitalReader.py to benchmark')
+    parser.add_argument('-d', '--durations', default='600,3600', help='comma separated file durations in seconds')
+    parser.add_argument('--dir', default='vital_bench', help='where the synthetic files are kept between runs')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('-o', '--output', default=None, help='save the results as JSON')
+    parser.add_argument('-c', '--compare', default=None, help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    run = run_benchmark(args.reader, [int(d) for d in args.durations.split(',')], args.dir, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(run, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
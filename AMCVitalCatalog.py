@@ -0,0 +1,215 @@
+import os
+import sys
+import csv
+import time
+import struct
+import sqlite3
+import argparse
+import datetime
+import concurrent.futures
+import AMCVitalReader as vr
+
+# SQLite catalog of the devices and tracks of every .vital file under a directory, with the UTC
+# span and size of each track, so that cohort queries do not have to open the files again.
+schema = '''
+CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER,
+    version INTEGER, tzbias INTEGER, inst_id INTEGER, prog_ver INTEGER, truncated INTEGER, error TEXT, scanned REAL);
+CREATE TABLE IF NOT EXISTS devices (file_id INTEGER, did INTEGER, typename TEXT, devname TEXT, port TEXT);
+CREATE TABLE IF NOT EXISTS tracks (file_id INTEGER, tid INTEGER, did INTEGER, typename TEXT, name TEXT, unit TEXT,
+    rec_type INTEGER, rec_fmt INTEGER, srate REAL, first_dt REAL, last_dt REAL, records INTEGER, samples INTEGER);
+CREATE INDEX IF NOT EXISTS tracks_name ON tracks (name, typename);
+CREATE INDEX IF NOT EXISTS tracks_time ON tracks (first_dt, last_dt);
+CREATE INDEX IF NOT EXISTS devices_file ON devices (file_id);
+CREATE INDEX IF NOT EXISTS tracks_file ON tracks (file_id);
+'''
+
+def connect(database):
+    db = sqlite3.connect(database)
+    db.executescript(schema)
+    return db
+
+def find_files(root):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith('.vital'):
+                found.append(os.path.abspath(os.path.join(dirpath, name)))
+    return sorted(found)
+
+def text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+# Reads one file without decoding any sample: only the header, the metadata packets and the
+# dt/tid/sample count of each record. last_dt of a wave track is the end of its last record.
+def scan_file(filename):
+    stat = os.stat(filename)
+    entry = {'path': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'devices': [], 'tracks': [],
+             'error': ''}
+    try:
+        with vr.vital_reader(filename) as reader:
+            reader.read_header()
+            if reader.signature != b'VITA':
+                raise ValueError('Not a vital file.')
+            span = {}
+            for packet_type, buf, pos, end, offset in reader.iter_packets():
+                if (packet_type == 1):  # SAVE_REC
+                    dt, tid = struct.unpack_from('<dH', buf, pos + 2)
+                    track = reader.track.get(tid)
+                    number = 1
+                    end_dt = dt
+                    if track is not None and (track.rec_type == 1 or track.rec_type == 6):
+                        number = struct.unpack_from('<L', buf, pos + 12)[0]
+                        if track.srate > 0:
+                            end_dt = dt + number / track.srate
+                    s = span.get(tid)
+                    if s is None:
+                        span[tid] = [dt, dt, end_dt, 1, number]
+                    else:
+                        s[0] = min(s[0], dt)
+                        s[1] = max(s[1], dt)
+                        s[2] = max(s[2], end_dt)
+                        s[3] += 1
+                        s[4] += number
+                elif (packet_type == 0):  # SAVE_TRKINFO
+                    reader.parse_trkinfo(buf, pos, end)
+                elif (packet_type == 9):  # SAVE_DEVINFO
+                    reader.parse_devinfo(buf, pos, end)
+        entry.update(version=reader.version, tzbias=reader.tzbias, inst_id=reader.inst_id, prog_ver=reader.prog_ver,
+                     truncated=int(bool(reader.truncated)))
+        for device in reader.device.values():
+            entry['devices'].append((device.did, text(device.typename), text(device.devname), text(device.port)))
+        for tid, track in reader.track.items():
+            first, last, end, records, samples = span.get(tid, (None, None, None, 0, 0))
+            if track.rec_type != 1 and track.rec_type != 6:
+                end = last
+            entry['tracks'].append((tid, track.did, reader.get_typename(track.did), text(track.name), text(track.unit),
+                                    track.rec_type, track.rec_fmt, track.srate, first, end, records, samples))
+    except Exception as e:
+        entry['error'] = '%s: %s' % (type(e).__name__, e)
+    return entry
+
+def store(db, entry):
+    db.execute('DELETE FROM devices WHERE file_id IN (SELECT file_id FROM files WHERE path = ?)', (entry['path'],))
+    db.execute('DELETE FROM tracks WHERE file_id IN (SELECT file_id FROM files WHERE path = ?)', (entry['path'],))
+    db.execute('DELETE FROM files WHERE path = ?', (entry['path'],))
+    cursor = db.execute('INSERT INTO files (path, size, mtime_ns, version, tzbias, inst_id, prog_ver, truncated, error, scanned) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (entry['path'], entry['size'], entry['mtime_ns'], entry.get('version'), entry.get('tzbias'),
+                         entry.get('inst_id'), entry.get('prog_ver'), entry.get('truncated'), entry['error'], time.time()))
+    file_id = cursor.lastrowid
+    db.executemany('INSERT INTO devices VALUES (?, ?, ?, ?, ?)', [(file_id,) + d for d in entry['devices']])
+    db.executemany('INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(file_id,) + t for t in entry['tracks']])
+
+def remove(db, path):
+    db.execute('DELETE FROM devices WHERE file_id IN (SELECT file_id FROM files WHERE path = ?)', (path,))
+    db.execute('DELETE FROM tracks WHERE file_id IN (SELECT file_id FROM files WHERE path = ?)', (path,))
+    db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+# Scans root into the catalog. Only files that are new or whose size or mtime changed are read
+# again (in parallel worker processes); files that disappeared are dropped. Returns the counts.
+def build_catalog(database, root, workers=None, progress=True):
+    db = connect(database)
+    known = {path: (size, mtime_ns) for path, size, mtime_ns in db.execute('SELECT path, size, mtime_ns FROM files')}
+    files = find_files(root)
+    todo = []
+    for filename in files:
+        stat = os.stat(filename)
+        if known.get(filename) != (stat.st_size, stat.st_mtime_ns):
+            todo.append(filename)
+    present = set(files)
+    removed = [path for path in known if path not in present and os.path.abspath(path).startswith(os.path.abspath(root) + os.sep)]
+    for path in removed:
+        remove(db, path)
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(scan_file, filename): filename for filename in todo}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            try:
+                entry = future.result()
+            except Exception as e:  # the worker itself died
+                stat = os.stat(futures[future])
+                entry = {'path': futures[future], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'devices': [],
+                         'tracks': [], 'error': '%s: %s' % (type(e).__name__, e)}
+            store(db, entry)
+            db.commit()
+            failed += 1 if entry['error'] else 0
+            if progress:
+                print('[%d/%d] %.1fs %s%s' % (done, len(todo), time.perf_counter() - start, entry['path'],
+                                              ' : ' + entry['error'] if entry['error'] else ''))
+    db.commit()
+    db.close()
+    return {'files': len(files), 'scanned': len(todo), 'unchanged': len(files) - len(todo), 'removed': len(removed), 'failed': failed}
+
+def to_epoch(value, tz=None):
+    if isinstance(value, datetime.datetime):
+        return vr.datetime_to_epoch(value, tz)
+    return value
+
+# Tracks matching every given condition, one row per (file, track) with path, typename, name,
+# first_dt and last_dt. [t_start, t_end) (UTC seconds or datetimes) must overlap the track's span.
+def find_tracks(database, typename=None, trackname=None, t_start=None, t_end=None, tz=None):
+    where = ["files.error = ''"]
+    args = []
+    if typename:
+        where.append('tracks.typename = ?')
+        args.append(typename)
+    if trackname:
+        where.append('tracks.name = ?')
+        args.append(trackname)
+    if t_end is not None:
+        where.append('tracks.first_dt < ?')
+        args.append(to_epoch(t_end, tz))
+    if t_start is not None:
+        where.append('tracks.last_dt > ?')
+        args.append(to_epoch(t_start, tz))
+    db = connect(database)
+    rows = db.execute('SELECT files.path, tracks.typename, tracks.name, tracks.first_dt, tracks.last_dt, tracks.records, tracks.samples '
+                      'FROM tracks JOIN files ON files.file_id = tracks.file_id WHERE ' + ' AND '.join(where) +
+                      ' ORDER BY files.path, tracks.typename, tracks.name', args).fetchall()
+    db.close()
+    return rows
+
+def find_files_with(database, typename=None, trackname=None, t_start=None, t_end=None, tz=None):
+    return sorted(set(row[0] for row in find_tracks(database, typename, trackname, t_start, t_end, tz)))
+
+# Writes the matches as an AMCVitalBatch manifest (start/end are left empty unless given).
+def write_manifest(filename, rows, start='', end='', label=''):
+    with open(filename, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(['file', 'device', 'track', 'start', 'end', 'label'])
+        for row in rows:
+            csv_writer.writerow([row[0], row[1], row[2], start, end, label])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and query a SQLite catalog of .vital files.')
+    parser.add_argument('-d', '--database', default='vital_catalog.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='scan a directory tree (only new or changed files are read)')
+    build.add_argument('root')
+    build.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    build.add_argument('-q', '--quiet', action='store_true', help='do not print progress')
+    query = commands.add_parser('query', help='list the files/tracks matching device, track and time span')
+    query.add_argument('--device', default=None)
+    query.add_argument('--track', default=None)
+    query.add_argument('--start', default=None, help='local time such as 2018-04-25 08:03:52')
+    query.add_argument('--end', default=None)
+    query.add_argument('--manifest', default=None, help='write the matches as an AMCVitalBatch manifest')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        counts = build_catalog(args.database, args.root, args.workers, not args.quiet)
+        print('%(files)d files: %(scanned)d scanned, %(unchanged)d unchanged, %(removed)d removed, %(failed)d failed' % counts)
+        return 1 if counts['failed'] else 0
+    start = datetime.datetime.fromisoformat(args.start) if args.start else None
+    end = datetime.datetime.fromisoformat(args.end) if args.end else None
+    rows = find_tracks(args.database, args.device, args.track, start, end)
+    if args.manifest:
+        write_manifest(args.manifest, rows, args.start or '', args.end or '')
+    for row in rows:
+        print('%s,%s,%s,%s,%s' % (row[0], row[1], row[2], datetime.datetime.fromtimestamp(row[3]) if row[3] is not None else '',
+                                  datetime.datetime.fromtimestamp(row[4]) if row[4] is not None else ''))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
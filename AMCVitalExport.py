@@ -0,0 +1,190 @@
+import os
+import sys
+import zipfile
+import argparse
+import numpy as np
+import AMCVitalReader as vr
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Every format keeps the [dt, value] columns of read_value_csv_form and read_wave_csv_form: one row
+# per number, or one row per wave sample with dt set to the segment start on the first sample of each
+# segment and 0 elsewhere. times='sample' puts the UTC time of every wave sample in dt instead.
+formats = ['csv', 'npy', 'npz', 'parquet']
+
+class csv_sink(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'w', newline='')
+        self.rows = 0
+
+    # A dt of 0 (wave samples without a segment marker) is written as the integer 0, as csv.writer
+    # does for the rows of read_wave_csv_form.
+    def write(self, dt, value):
+        text = np.array(vr.format_values(dt), dtype=object)
+        text[dt == 0] = '0'
+        vr.write_csv_columns(self.file, [text.tolist(), vr.format_values(value)])
+        self.rows += len(dt)
+
+    def close(self):
+        self.file.close()
+
+# A (rows, 2) float64 .npy written chunk by chunk; the header reserves room for the final shape,
+# which is filled in by close().
+class npy_sink(object):
+    header_size = 128
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(self.header(0))
+        self.rows = 0
+
+    def header(self, rows):
+        text = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, 2), }" % rows
+        return b'\x93NUMPY\x01\x00' + np.uint16(self.header_size - 10).tobytes() + text.ljust(self.header_size - 11).encode('latin-1') + b'\n'
+
+    def write(self, dt, value):
+        self.file.write(np.column_stack([dt, value]).astype('<f8').tobytes())
+        self.rows += len(dt)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.header(self.rows))
+        self.file.close()
+
+class parquet_sink(object):
+    def __init__(self, filename):
+        if pyarrow is None:
+            raise ValueError('pyarrow is required for parquet export.')
+        self.filename = filename
+        self.schema = pyarrow.schema([('dt', pyarrow.float64()), ('value', pyarrow.float64())])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.rows = 0
+
+    def write(self, dt, value):
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(dt, pyarrow.float64()),
+                                                          pyarrow.array(value, pyarrow.float64())], schema=self.schema))
+        self.rows += len(dt)
+
+    def close(self):
+        self.writer.close()
+
+sinks = {'csv': csv_sink, 'npy': npy_sink, 'parquet': parquet_sink}
+
+def track_name(reader, track):
+    return '%s_%s' % (reader.get_typename(track.did) or 'nodevice', track.name.decode('utf-8'))
+
+# Rows of one track, gathered record by record and flushed to its sink every chunk_size rows.
+class track_export(object):
+    def __init__(self, track, sink, times, tolerance, chunk_size):
+        self.track = track
+        self.sink = sink
+        self.times = times
+        self.tolerance = tolerance
+        self.chunk_size = chunk_size
+        self.dt = []
+        self.value = []
+        self.rows = 0
+        self.end = None  # where the next wave record is expected to start
+        self.segment_dt = None
+        self.segment_samples = 0
+        self.marker = None
+
+    def add(self, dt, number, data):
+        track = self.track
+        if track.rec_type == 2:
+            self.dt.append(np.array([dt]))
+            self.value.append(np.array([number], dtype=np.float32))
+            self.rows += 1
+        else:
+            # same rule as vital_segments: a record more than tolerance away from the previous end starts a segment
+            if self.end is None or not abs(dt - self.end) <= self.tolerance:
+                self.segment_dt = dt
+                self.segment_samples = 0
+                self.marker = dt
+            self.end = dt + number / track.srate if track.srate > 0 else np.nan
+            if data is None or number == 0:
+                return
+            samples = vr.chunk_samples(track, number, data)
+            if self.times == 'sample':
+                self.dt.append(self.segment_dt + np.arange(self.segment_samples, self.segment_samples + len(samples)) / track.srate)
+            else:
+                marks = np.zeros(len(samples))
+                if self.marker is not None:
+                    marks[0] = self.marker
+                    self.marker = None
+                self.dt.append(marks)
+            self.segment_samples += len(samples)
+            self.value.append(samples)
+            self.rows += len(samples)
+        if self.rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.sink.write(np.concatenate(self.dt), np.concatenate(self.value))
+        self.dt = []
+        self.value = []
+        self.rows = 0
+
+# Streams the selected tracks ((typename, trackname) pairs, as for read_packets) of one file into
+# out, which is a directory for csv/npy/parquet (one <device>_<track> file per track) and the file
+# name for npz. Only chunk_size rows per track are held in memory. Returns {name: (filename, rows)}.
+def export_tracks(reader, tracks, out, fmt='csv', times='segment', tolerance=1.0, chunk_size=1 << 20):
+    if fmt not in formats:
+        raise ValueError('Unknown export format : %s' % fmt)
+    if fmt == 'parquet' and pyarrow is None:
+        raise ValueError('pyarrow is required for parquet export.')
+    directory = out if fmt != 'npz' else out + '.parts%d' % os.getpid()
+    os.makedirs(directory, exist_ok=True)
+    exports = {}
+    try:
+        reader.read_header()
+        for track, dt, number, data in reader.iter_records(tracks):
+            export = exports.get(track)
+            if export is None:
+                if track.rec_type == 5:
+                    raise ValueError('String tracks cannot be exported. Track : %s' % track.name.decode('utf-8'))
+                sink = sinks['npy' if fmt == 'npz' else fmt](os.path.join(directory, '%s.%s' % (track_name(reader, track), 'npy' if fmt == 'npz' else fmt)))
+                export = exports[track] = track_export(track, sink, times, tolerance, chunk_size)
+            export.add(dt, number, data)
+    finally:
+        for export in exports.values():
+            export.flush()
+            export.sink.close()
+    result = {track_name(reader, track): (export.sink.filename, export.sink.rows) for track, export in exports.items()}
+    if fmt == 'npz':
+        # np.savez layout: one stored .npy member per track
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED, allowZip64=True) as npz:
+            for name, (filename, rows) in result.items():
+                npz.write(filename, name + '.npy')
+                os.remove(filename)
+        os.rmdir(directory)
+        result = {name: (out, rows) for name, (filename, rows) in result.items()}
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export tracks of a .vital file in chunks.')
+    parser.add_argument('file', help='.vital file')
+    parser.add_argument('out', help='output directory (output file for npz)')
+    parser.add_argument('-t', '--track', action='append', required=True,
+                        help='DEVICE/TRACK, or DEVICE/ for every track of a device; may be repeated')
+    parser.add_argument('-f', '--format', choices=formats, default='csv')
+    parser.add_argument('--times', choices=['segment', 'sample'], default='segment',
+                        help='dt column of wave tracks: segment start markers (as read_wave_csv_form) or per-sample times')
+    args = parser.parse_args(argv)
+
+    tracks = [(t.split('/', 1)[0], t.split('/', 1)[1] or None) if '/' in t else ('', t) for t in args.track]
+    with vr.vital_reader(args.file) as reader:
+        result = export_tracks(reader, tracks, args.out, args.format, args.times)
+    for name, (filename, rows) in sorted(result.items()):
+        print('%s : %d rows -> %s' % (name, rows, filename))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,13 @@
 import io
-import gzip
+import os
+import bisect
+import json
+import shutil
+import hashlib
+import itertools
+import zlib
 import struct
+import time
 import csv
 import datetime
 import numpy as np
@@ -13,37 +20,337 @@ class KST(datetime.tzinfo):
     def tzname(self, dt):
         return "KST"
 
-class vital_device:
-    did = ""
-    typename = ""
-    devname = ""
-    port = ""
-
-class vital_track:
-    tid = ""
-    rec_type = ""
-    rec_fmt = ""
-    name = ""
-    unit = ""
-    minval = ""
-    maxval = ""
-    color = ""
-    srate = 0
-    adc_gain = ""
-    adc_offset = ""
-    mon_type = ""
-    did = ""
-    st = 0
-    dt = []
-    v_number = []
-    v_wave = []
-    v_string = []
-
-class vital_record:
-    infolen = 0
-    dt = 0
-    tid = 0
-    data = []
+class vital_device(object):
+    __slots__ = ('did', 'typename', 'devname', 'port')
+
+    def __init__(self):
+        self.did = ""
+        self.typename = ""
+        self.devname = ""
+        self.port = ""
+
+# Wave samples are kept in raw as stored in the file: float32 for rec_fmt 1 and the int16 ADC
+# values for rec_fmt 5/6, which are scaled with adc_gain/adc_offset only when they are read.
+class vital_track(object):
+    __slots__ = ('tid', 'rec_type', 'rec_fmt', 'name', 'unit', 'minval', 'maxval', 'color', 'srate',
+                 'adc_gain', 'adc_offset', 'mon_type', 'did', 'st', 'dt', 'v_number', 'raw', 'v_string',
+                 'segments', 'stats', 'pyramid', 'scaled')
+
+    def __init__(self):
+        self.tid = ""
+        self.rec_type = ""
+        self.rec_fmt = ""
+        self.name = ""
+        self.unit = ""
+        self.minval = ""
+        self.maxval = ""
+        self.color = ""
+        self.srate = 0
+        self.adc_gain = ""
+        self.adc_offset = ""
+        self.mon_type = ""
+        self.did = ""
+        self.st = 0
+        self.dt = []
+        self.v_number = []
+        self.raw = []
+        self.v_string = []
+        self.segments = None
+        self.stats = None
+        self.pyramid = None
+        self.scaled = None
+
+    # A track with the same TRKINFO metadata and no records.
+    def copy_info(self):
+        track = vital_track()
+        for key in ('tid', 'rec_type', 'rec_fmt', 'name', 'unit', 'minval', 'maxval', 'color', 'srate',
+                    'adc_gain', 'adc_offset', 'mon_type', 'did'):
+            setattr(track, key, getattr(self, key))
+        return track
+
+    # Scaled float32 samples of the whole track. For ADC tracks they are computed on first access
+    # and kept until raw is replaced; wave() scales only a slice.
+    @property
+    def v_wave(self):
+        if isinstance(self.raw, list):
+            return self.raw
+        if self.scaled is None or self.scaled[0] is not self.raw:
+            self.scaled = (self.raw, self.wave())
+        return self.scaled[1]
+
+    @v_wave.setter
+    def v_wave(self, value):
+        self.raw = value
+
+    # Samples start to stop scaled to dtype; rec_fmt 1 tracks return a view when dtype is float32.
+    def wave(self, start=None, stop=None, dtype=np.float32):
+        raw = self.raw[start:stop]
+        if raw.dtype.kind == 'f':
+            return raw.astype(dtype, copy=False)
+        return (raw * self.adc_gain + self.adc_offset).astype(dtype, copy=False)
+
+    # Segment model of a wave track, computed once and reused until dt is replaced.
+    def get_segments(self, tolerance=1.0):
+        if self.segments is None or self.segments.dt is not self.dt or self.segments.tolerance != tolerance:
+            self.segments = vital_segments(self.dt, self.v_number, self.srate, tolerance)
+        return self.segments
+
+    # Rebuilt when the samples are replaced; a pyramid from open_pyramids (raw None) is always kept.
+    def get_pyramid(self):
+        if self.pyramid is None or (self.pyramid.raw is not None and self.pyramid.raw is not self.raw):
+            self.pyramid = vital_pyramid(self)
+        return self.pyramid
+
+# Continuous stretches of a wave track. A new segment starts at every record whose dt differs by
+# more than tolerance seconds from the end of the previous record; start/end are sample offsets
+# into v_wave and gap is that difference (0 for the first segment).
+class vital_segments(object):
+
+    def __init__(self, dt, v_number, srate, tolerance=1.0):
+        self.dt = dt
+        self.srate = srate
+        self.tolerance = tolerance
+        number = np.asarray(v_number, dtype=np.int64)
+        dt = np.asarray(dt, dtype=np.float64)
+        self.offsets = np.concatenate(([0], np.cumsum(number)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gap = np.diff(dt) - number[:-1] / srate
+        breaks = np.nonzero(~(np.abs(gap) <= tolerance))[0] + 1
+        self.start_record = np.concatenate(([0], breaks)).astype(np.int64) if len(dt) else np.array([], dtype=np.int64)
+        self.start = self.offsets[self.start_record]
+        self.end = np.append(self.start[1:], self.offsets[-1]) if len(dt) else np.array([], dtype=np.int64)
+        self.start_dt = dt[self.start_record]
+        self.gap = np.concatenate(([0.0], gap[breaks - 1])) if len(dt) else np.array([], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.start)
+
+    def views(self, track):
+        return [[self.start_dt[i], track.wave(self.start[i], self.end[i])] for i in range(len(self))]
+
+    # Sample offset of the first sample at or after t, like np.searchsorted on the sample times.
+    def bound(self, t):
+        n = self.end - self.start
+        with np.errstate(divide='ignore', invalid='ignore'):
+            found = np.nonzero((n > 0) & (self.start_dt + (n - 1) / self.srate >= t))[0]
+        if len(found) == 0:
+            return int(self.offsets[-1])
+        i = found[0]
+        return int(self.start[i]) + sample_bound(self.start_dt[i], self.srate, int(n[i]), t)
+
+    # UTC time of the samples at the offsets p.
+    def at(self, p):
+        i = np.maximum(np.searchsorted(self.start, p, 'right') - 1, 0)
+        return self.start_dt[i] + (p - self.start[i]) / self.srate
+
+    # UTC times of the samples p_start to p_end.
+    def times(self, p_start, p_end):
+        t = np.empty(p_end - p_start, dtype=np.float64)
+        for i in range(len(self)):
+            a = max(self.start[i], p_start)
+            b = min(self.end[i], p_end)
+            if a < b:
+                t[a - p_start:b - p_start] = self.start_dt[i] + np.arange(a - self.start[i], b - self.start[i]) / self.srate
+        return t
+
+# Min/max/mean of a wave track over blocks of base << k samples for every level k, each level
+# halving the previous one down to a single block. Blocks follow the sample offsets, so a block
+# may span a gap; its time is that of its first sample.
+class vital_pyramid(object):
+    base = 16
+
+    def __init__(self, track=None):
+        self.raw = None
+        self.count = 0
+        self.segments = None
+        self.vmin = []
+        self.vmax = []
+        self.vmean = []
+        if track is None:
+            return
+        self.raw = track.raw
+        self.segments = track.get_segments()
+        self.count = int(self.segments.offsets[-1])
+        if self.count == 0:
+            return
+        v = track.wave(0, self.count)
+        starts = np.arange(0, self.count, self.base)
+        valid = ~np.isnan(v)
+        n = np.add.reduceat(valid, starts, dtype=np.int64)
+        with np.errstate(invalid='ignore'):
+            self.vmin.append(np.fmin.reduceat(v, starts))
+            self.vmax.append(np.fmax.reduceat(v, starts))
+            self.vmean.append((np.add.reduceat(np.where(valid, v, 0), starts, dtype=np.float64) / n).astype(np.float32))
+            while len(n) > 1:
+                pairs = np.arange(0, len(n), 2)
+                total = np.add.reduceat(n, pairs)
+                self.vmin.append(np.fmin.reduceat(self.vmin[-1], pairs))
+                self.vmax.append(np.fmax.reduceat(self.vmax[-1], pairs))
+                weighted = np.where(n > 0, self.vmean[-1].astype(np.float64) * n, 0)
+                self.vmean.append((np.add.reduceat(weighted, pairs) / total).astype(np.float32))
+                n = total
+
+    # At most n display points (t, vmin, vmax, vmean) for the samples between t_start and t_end
+    # (UTC seconds). Ranges of up to n samples return the samples themselves when the pyramid was
+    # built from them.
+    def query(self, track, t_start=None, t_end=None, n=2000):
+        p_start = 0 if t_start is None else self.segments.bound(t_start)
+        p_end = self.count if t_end is None else self.segments.bound(t_end)
+        if p_end <= p_start:
+            empty = np.array([], dtype=np.float32)
+            return np.array([], dtype=np.float64), empty, empty, empty
+        if p_end - p_start <= n and self.raw is track.raw:
+            v = track.wave(p_start, p_end)
+            return self.segments.times(p_start, p_end), v, v, v
+        for level in range(len(self.vmin)):
+            size = self.base << level
+            b_start = p_start // size
+            b_end = -(-p_end // size)
+            if b_end - b_start <= n:
+                break
+        t = self.segments.at(np.maximum(np.arange(b_start, b_end) * size, p_start))
+        return t, self.vmin[level][b_start:b_end], self.vmax[level][b_start:b_end], self.vmean[level][b_start:b_end]
+
+# Summary of a track accumulated batch by batch while records are decoded, so reports never go
+# back over the samples. count/valid/nan are sample counts (records for string tracks), mean and
+# m2 are merged with Chan's update, and gaps counts breaks longer than tolerance seconds.
+class vital_stats(object):
+    __slots__ = ('records', 'count', 'valid', 'nan', 'min', 'max', 'mean', 'm2', 'gaps', 'duration',
+                 'first_dt', 'last_dt', 'end_dt')
+    fields = ['records', 'count', 'valid', 'nan', 'min', 'max', 'mean', 'm2', 'gaps', 'duration',
+              'first_dt', 'last_dt', 'end_dt']
+    tolerance = 1.0
+    chunk_size = 1 << 16
+
+    def __init__(self):
+        self.records = 0
+        self.count = 0
+        self.valid = 0
+        self.nan = 0
+        self.min = np.nan
+        self.max = np.nan
+        self.mean = np.nan
+        self.m2 = 0.0
+        self.gaps = 0
+        self.duration = 0.0
+        self.first_dt = np.nan
+        self.last_dt = np.nan
+        self.end_dt = np.nan  # where the next wave record is expected to start
+
+    @property
+    def variance(self):
+        finite = self.count - self.nan
+        return self.m2 / finite if finite > 0 and not np.isnan(self.mean) else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    # Adds a batch of records: dt/number as in iter_records and the samples they carry.
+    def update(self, track, dt, number, samples=None):
+        if len(dt) == 0:
+            return
+        dt = np.asarray(dt, dtype=np.float64)
+        self.records += len(dt)
+        if np.isnan(self.first_dt):
+            self.first_dt = dt[0]
+        if track.rec_type == 1 or track.rec_type == 6:
+            number = np.asarray(number, dtype=np.int64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gap = np.diff(np.concatenate(([self.end_dt], dt))) - np.concatenate(([0.0], number[:-1] / track.srate))
+                end = dt + number / track.srate
+            if self.records == len(dt):
+                gap = gap[1:]
+            self.gaps += int(np.count_nonzero(~(np.abs(gap) <= self.tolerance)))
+            self.end_dt = end[-1]
+            self.last_dt = end[-1] if np.isnan(self.last_dt) else max(self.last_dt, np.nanmax(end))
+            self.duration += number.sum() / track.srate if track.srate > 0 else 0.0
+        else:
+            self.last_dt = dt[-1] if np.isnan(self.last_dt) else max(self.last_dt, dt.max())
+            self.duration = self.last_dt - self.first_dt
+        if track.rec_type == 5:
+            self.count += len(dt)
+        elif samples is None:
+            return
+        elif track.rec_type != 2 and track.rec_fmt != 1:
+            self.add_raw(track, samples)
+        else:
+            for i in range(0, len(samples), self.chunk_size):
+                self.add(samples[i:i + self.chunk_size], track.minval, track.maxval)
+
+    def add(self, values, minval, maxval):
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.valid += int(np.count_nonzero((values >= minval) & (values <= maxval)))
+        finite = values
+        if np.isnan(values.min()):  # min propagates NaN, so the mask is only built when needed
+            finite = values[~np.isnan(values)]
+            self.nan += len(values) - len(finite)
+            if len(finite) == 0:
+                return
+        d = finite.astype(np.float64)
+        mean_b = d.sum() / len(d)
+        d -= mean_b
+        self.merge(len(finite), mean_b, float(np.dot(d, d)), float(finite.min()), float(finite.max()))
+
+    # Raw int16 ADC samples, never converted to float: scaling is monotonic, so minval/maxval
+    # become a contiguous range of raw values, and mean and m2 come from exact integer sums that
+    # are scaled afterwards.
+    def add_raw(self, track, raw):
+        if len(raw) == 0:
+            return
+        self.count += len(raw)
+        ends = scale_wave(track, np.array([raw.min(), raw.max()], dtype=raw.dtype))
+        if np.isnan(ends).any():
+            self.nan += len(raw)
+            return
+        table = scale_wave(track, np.arange(-32768, 32768).astype(np.int16))
+        valid = np.flatnonzero((table >= track.minval) & (table <= track.maxval))
+        if len(valid) and valid[-1] - valid[0] + 1 == len(valid):
+            lo, hi = valid[0] - 32768, valid[-1] - 32768
+            # raw - lo wraps around in int16, so one unsigned comparison checks both bounds
+            self.valid += int(np.count_nonzero((raw - np.int16(lo)).view(np.uint16) <= np.uint16(hi - lo)))
+        elif len(valid):
+            self.valid += int(np.count_nonzero(np.isin(raw, (valid - 32768).astype(np.int16))))
+        n_b = len(raw)
+        s1 = int(raw.sum(dtype=np.int64))
+        s2 = int(np.einsum('i,i->', raw, raw, dtype=np.int64))
+        mean_b = track.adc_gain * s1 / n_b + track.adc_offset
+        m2_b = track.adc_gain * track.adc_gain * (s2 * n_b - s1 * s1) / n_b
+        self.merge(n_b, mean_b, m2_b, ends.min(), ends.max())
+
+    # Chan's update with a batch of n_b finite values.
+    def merge(self, n_b, mean_b, m2_b, min_b, max_b):
+        n_a = self.count - self.nan - n_b
+        if n_a == 0:
+            self.mean, self.m2 = float(mean_b), m2_b
+            self.min, self.max = float(min_b), float(max_b)
+            return
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / (n_a + n_b)
+        self.m2 += m2_b + delta * delta * n_a * n_b / (n_a + n_b)
+        self.min = min(self.min, float(min_b))
+        self.max = max(self.max, float(max_b))
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.fields}
+
+    @staticmethod
+    def from_dict(d):
+        stats = vital_stats()
+        for key in stats.fields:
+            setattr(stats, key, d[key])
+        return stats
+
+class vital_record(object):
+    __slots__ = ('infolen', 'dt', 'tid', 'data')
+
+    def __init__(self):
+        self.infolen = 0
+        self.dt = 0
+        self.tid = 0
+        self.data = []
 
 def convert_binary_to_string(binary_list):
     r = []
@@ -51,31 +358,608 @@ def convert_binary_to_string(binary_list):
         r.append(binary_list[i].decode('utf-8'))
     return r
 
+def datetime_to_epoch(value, tz=None):
+    if value.tzinfo is None and tz is not None:
+        value = value.replace(tzinfo=tz)
+    return value.timestamp()
+
+# UTC offsets (seconds) of the local time zone, or of tz, at each time in t. The offset is
+# looked up once per hour so that DST changes inside a recording are still honoured.
+def utc_offsets(t, tz=None):
+    def offset(x):
+        utc = datetime.datetime.fromtimestamp(x, datetime.timezone.utc)
+        if tz is None:
+            return utc.astimezone().utcoffset().total_seconds()
+        return tz.utcoffset(utc.replace(tzinfo=None)).total_seconds()
+    first, last = offset(float(t[0])), offset(float(t[-1]))
+    if first == last:
+        return first
+    hours, inverse = np.unique(np.floor(t / 3600), return_inverse=True)
+    return np.array([offset(h * 3600) for h in hours])[inverse]
+
+# Wall-clock datetime64[us] values of UTC seconds, rounded like datetime.datetime.fromtimestamp.
+def epoch_to_datetime64(t, tz=None):
+    t = np.asarray(t, dtype=np.float64)
+    if len(t) == 0:
+        return np.array([], dtype='datetime64[us]')
+    seconds = np.floor(t)
+    us = seconds.astype(np.int64) * 1000000 + np.round((t - seconds) * 1e6).astype(np.int64)
+    return (us + np.round(utc_offsets(t, tz) * 1e6).astype(np.int64)).astype('datetime64[us]')
+
+# First sample index j in [0, n] of a segment starting at start with start + j / srate >= t.
+def sample_bound(start, srate, n, t):
+    j = int(min(max(np.ceil((t - start) * srate), 0), n))
+    while j > 0 and start + (j - 1) / srate >= t:
+        j -= 1
+    while j < n and start + j / srate < t:
+        j += 1
+    return j
+
+# Values of a wave track at the times t (a regular grid of rate srate). Upsampling interpolates
+# linearly within segments, downsampling averages the samples of each grid interval; times that
+# fall in a gap are NaN.
+def resample_wave(t_track, t, srate):
+    segments = t_track.get_segments()
+    out = np.full(len(t), np.nan)
+    if t_track.srate > srate:
+        p_start = segments.bound(t[0])
+        p_end = segments.bound(t[-1] + 1.0 / srate)
+        bins = np.floor((segments.times(p_start, p_end) - t[0]) * srate).astype(np.int64)
+        keep = (bins >= 0) & (bins < len(t))
+        counts = np.bincount(bins[keep], minlength=len(t))
+        sums = np.bincount(bins[keep], weights=t_track.wave(p_start, p_end, np.float64)[keep], minlength=len(t))
+        np.divide(sums, counts, out=out, where=counts > 0)
+        return out
+    p_start = max(segments.bound(t[0]) - 1, 0)
+    p_end = min(segments.bound(t[-1]) + 1, int(segments.offsets[-1]))
+    if p_start >= p_end:
+        return out
+    out = np.interp(t, segments.times(p_start, p_end), t_track.wave(p_start, p_end))
+    last = segments.start_dt + (segments.end - segments.start - 1) / t_track.srate
+    i = np.searchsorted(segments.start_dt, t, side='right') - 1
+    out[(i < 0) | (t > last[np.maximum(i, 0)])] = np.nan
+    return out
+
+# Values of a numeric track at the times t, holding the last value ('last') or interpolating
+# between values ('linear'); NaN before the first and, for 'linear', after the last value.
+def resample_number(dt, value, t, fill='last'):
+    dt = np.asarray(dt, dtype=np.float64)
+    if len(dt) == 0:
+        return np.full(len(t), np.nan)
+    if fill == 'linear':
+        return np.interp(t, dt, value, left=np.nan, right=np.nan)
+    i = np.searchsorted(dt, t, side='right') - 1
+    return np.where(i >= 0, np.asarray(value)[np.maximum(i, 0)], np.nan)
+
+# Decompression backends by name, each a factory of a gzip-aware decompressobj. isal (python-isal)
+# is used by default when it is installed.
+def zlib_decompressor():
+    return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+decompressors = {'zlib': zlib_decompressor}
+try:
+    from isal import isal_zlib
+
+    def isal_decompressor():
+        return isal_zlib.decompressobj(isal_zlib.MAX_WBITS | 16)
+
+    decompressors['isal'] = isal_decompressor
+except ImportError:
+    pass
+default_decompressor = 'isal' if 'isal' in decompressors else 'zlib'
+
+# Restart points inside a gzip member, as in zlib's zran example: a deflate block boundary (its
+# input offset and the bits of the previous byte that belong to the block) and the 32 KiB window
+# before it, from which a raw inflate can resume without a decompressor snapshot. They need
+# inflate(Z_BLOCK), inflatePrime and inflateGetDictionary, which the zlib module does not expose,
+# so libz is called through ctypes; without it only member boundaries are restart points.
+try:
+    import ctypes
+    import ctypes.util
+
+    class z_stream(ctypes.Structure):
+        _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+                    ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+                    ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p), ('zalloc', ctypes.c_void_p),
+                    ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p), ('data_type', ctypes.c_int),
+                    ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+    libz = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+    z_stream_p = ctypes.POINTER(z_stream)
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [z_stream_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.argtypes = [z_stream_p, ctypes.c_int]
+    libz.inflateEnd.argtypes = [z_stream_p]
+    libz.inflatePrime.argtypes = [z_stream_p, ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [z_stream_p, ctypes.c_char_p, ctypes.c_uint]
+    libz.inflateGetDictionary.argtypes = [z_stream_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_uint)]  # zlib >= 1.2.8
+except (ImportError, OSError, AttributeError):
+    libz = None
+
+# A decompressobj-like inflater on libz. A gzip one (wbits 31) given spacing records a
+# (input offset, bits, output offset, window) point at the first block boundary after every
+# spacing bytes of output; a raw one (wbits -15) resumes at such a point and also consumes the
+# gzip trailer that follows the deflate stream before reporting eof.
+class block_inflater(object):
+    def __init__(self, wbits=31, spacing=None, bits=0, value=0, window=b''):
+        self.stream = z_stream()
+        self.out = ctypes.create_string_buffer(1 << 18)
+        if libz.inflateInit2_(ctypes.byref(self.stream), wbits, libz.zlibVersion(), ctypes.sizeof(z_stream)) != 0:
+            raise zlib.error('inflateInit2 failed')
+        if bits:
+            libz.inflatePrime(ctypes.byref(self.stream), bits, value)
+        if window:
+            libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window))
+        self.spacing = spacing
+        self.next_point = spacing
+        self.points = []
+        self.trailer = 8 if wbits < 0 else 0
+        self.ended = False
+        self.eof = False
+        self.unused_data = b''
+
+    def __del__(self):
+        if libz is not None and self.stream.state:
+            libz.inflateEnd(ctypes.byref(self.stream))
+
+    def decompress(self, data):
+        stream = self.stream
+        out = []
+        if not self.ended:
+            stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+            stream.avail_in = len(data)
+            flush = 5 if self.spacing else 0  # Z_BLOCK, Z_NO_FLUSH
+            while True:
+                stream.next_out = ctypes.addressof(self.out)
+                stream.avail_out = len(self.out)
+                ret = libz.inflate(ctypes.byref(stream), flush)
+                if ret != 0 and ret != 1 and ret != -5:  # Z_OK, Z_STREAM_END, Z_BUF_ERROR
+                    raise zlib.error('Error %d while decompressing data' % ret)
+                if stream.avail_out < len(self.out):
+                    out.append(ctypes.string_at(self.out, len(self.out) - stream.avail_out))
+                if ret == 1:
+                    self.ended = True
+                    break
+                if self.spacing and stream.data_type & 128 and not stream.data_type & 64 and stream.total_out >= self.next_point:
+                    window = ctypes.create_string_buffer(1 << 15)
+                    size = ctypes.c_uint(0)
+                    libz.inflateGetDictionary(ctypes.byref(stream), window, ctypes.byref(size))
+                    self.points.append((stream.total_in, stream.data_type & 7, stream.total_out, window.raw[:size.value]))
+                    self.next_point = stream.total_out + self.spacing
+                if ret == -5 or (stream.avail_in == 0 and stream.avail_out > 0):
+                    break
+            data = data[len(data) - stream.avail_in:] if self.ended else b''
+        if self.ended:
+            skip = min(self.trailer, len(data))
+            self.trailer -= skip
+            if self.trailer == 0:
+                self.eof = True
+                self.unused_data = data[skip:]
+        return b''.join(out)
+
+# A restart point inside a gzip member (see block_inflater); value is the byte before the
+# boundary, which holds its first bits.
+class deflate_point(object):
+    __slots__ = ('bits', 'window')
+
+    def __init__(self, bits, window):
+        self.bits = bits
+        self.window = window
+
+    def inflater(self, value):
+        return block_inflater(-15, bits=self.bits, value=value >> (8 - self.bits) if self.bits else 0, window=self.window)
+
+wave_dtype = {1: np.dtype('<f4'), 5: np.dtype('<i2'), 6: np.dtype('<i2')}
+
+def scale_wave(track, samples):
+    if track.rec_fmt == 1:
+        return samples.astype(np.float32, copy=False)
+    return (samples * track.adc_gain + track.adc_offset).astype(np.float32)
+
+# Text of every value as csv.writer writes it (shortest repr). Quantized data such as scaled ADC
+# samples has few distinct values, which are formatted once and looked up.
+def format_values(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'f' and len(values) > 1024:
+        u, inverse = np.unique(values, return_inverse=True)
+        if len(u) * 4 < len(values):
+            return np.array(u.astype(str).tolist(), dtype=object)[inverse.reshape(-1)].tolist()
+    return values.astype(str).tolist()
+
+# Writes columns of formatted values (lists of str of equal length) as CSV rows.
+def write_csv_columns(csvfile, columns):
+    if len(columns[0]):
+        csvfile.write('\r\n'.join(map(','.join, zip(*columns))) + '\r\n')
+
+# Samples of one record as streamed by iter_chunks: scaled float32 for waves, a one-element
+# array for numbers, bytes for strings and None for waves of an unsupported format.
+def chunk_samples(track, number, data):
+    if track.rec_type == 5:
+        return data
+    if track.rec_type == 2:
+        return np.array([number], dtype=np.float32)
+    if data is not None:
+        return scale_wave(track, np.frombuffer(data, dtype=wave_dtype[track.rec_fmt]))
+    return None
+
+# Raw samples of a wave track from its record payloads, as stored by vital_track.raw.
+def decode_wave(track, parts):
+    dtype = wave_dtype.get(track.rec_fmt)
+    if dtype is None or len(parts) == 0:
+        return np.array([], dtype=np.float32)
+    return np.frombuffer(bytearray().join(parts), dtype=dtype).astype(dtype.newbyteorder('='), copy=False)
+
+def iter_buffer_packets(buf):
+    pos = 0
+    while pos + 5 <= len(buf):
+        type, datalen = struct.unpack_from('<BL', buf, pos)
+        yield type, buf, pos + 5, pos + 5 + datalen, pos
+        pos += 5 + datalen
+
+# Seek index of a .vital file: per-track record tables (dt, uncompressed packet offset, sample
+# count), the raw SAVE_DEVINFO/SAVE_TRKINFO packets and inflate restart points. Restart points
+# inside a gzip member are deflate_points, saved as the boundary bits (-1 for a member start)
+# and their window; without libz they are zlib decompressor snapshots, which cannot be
+# serialized, so only member boundaries survive save/load.
+class vital_index(object):
+
+    def __init__(self):
+        self.source = None
+        self.meta = []
+        self.checkpoints = []
+        self.dt = {}
+        self.offset = {}
+        self.number = {}
+
+    def restart_point(self, offset):
+        i = bisect.bisect_right([c[1] for c in self.checkpoints], offset) - 1
+        return self.checkpoints[i] if i >= 0 else None
+
+    def save(self, filename):
+        points = [c for c in self.checkpoints if c[2] is None or isinstance(c[2], deflate_point)]
+        arrays = {'source': np.array(self.source, dtype=np.int64),
+                  'meta': np.frombuffer(b''.join(self.meta), dtype=np.uint8),
+                  'meta_len': np.array([len(m) for m in self.meta], dtype=np.int64),
+                  'checkpoints': np.array([c[:2] + (-1 if c[2] is None else c[2].bits,) for c in points], dtype=np.int64).reshape(-1, 3),
+                  'windows': np.frombuffer(b''.join(c[2].window for c in points if c[2] is not None), dtype=np.uint8),
+                  'window_len': np.array([len(c[2].window) for c in points if c[2] is not None], dtype=np.int64)}
+        for tid in self.dt:
+            arrays['dt_%d' % tid] = self.dt[tid]
+            arrays['offset_%d' % tid] = self.offset[tid]
+            arrays['number_%d' % tid] = self.number[tid]
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(filename):
+        if not os.path.exists(filename):
+            return None
+        index = vital_index()
+        with np.load(filename) as data:
+            index.source = tuple(int(v) for v in data['source'])
+            meta = data['meta'].tobytes()
+            pos = 0
+            for n in data['meta_len']:
+                index.meta.append(meta[pos:pos + n])
+                pos += n
+            windows = data['windows'].tobytes() if 'windows' in data.files else b''
+            lengths = iter(data['window_len'] if 'window_len' in data.files else [])
+            pos = 0
+            for c in data['checkpoints']:
+                if len(c) < 3 or c[2] < 0:
+                    index.checkpoints.append((int(c[0]), int(c[1]), None))
+                    continue
+                n = int(next(lengths))
+                if libz is not None:  # a deflate_point can only be resumed with libz
+                    index.checkpoints.append((int(c[0]), int(c[1]), deflate_point(int(c[2]), windows[pos:pos + n])))
+                pos += n
+            for key in data.files:
+                if key.startswith('dt_'):
+                    tid = int(key[3:])
+                    index.dt[tid] = data[key]
+                    index.offset[tid] = data['offset_%d' % tid]
+                    index.number[tid] = data['number_%d' % tid]
+        return index
+
+# Counters of the parses run while vital_reader.metrics is set (see vital_reader.instrument):
+# per packet type [count, bytes, seconds spent decoding], per track records and samples, the time
+# spent in decompression (including file reads) and the rest of the parse, and the largest block
+# and stream buffer. callback(type, offset, length, seconds) is called after every packet.
+# Nothing here runs unless a reader is instrumented.
+class vital_metrics(object):
+    packet_names = {0: 'TRKINFO', 1: 'REC', 6: 'CMD', 9: 'DEVINFO'}
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.packets = {}
+        self.records = {}
+        self.samples = {}
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.decompress_s = 0.0
+        self.parse_s = 0.0
+        self.finalize_s = 0.0
+        self.total_s = 0.0
+        self.peak_block = 0
+        self.peak_buffer = 0
+        self.error = None
+        self.last_packet = None  # (type, offset) of the packet being decoded when the parse stopped
+        self.exhausted = None
+
+    def count_blocks(self, blocks, reader):
+        clock = time.perf_counter
+        blocks = iter(blocks)
+        while True:
+            start = clock()
+            block = next(blocks, None)
+            self.decompress_s += clock() - start
+            if block is None:
+                break
+            self.uncompressed_bytes += len(block)
+            self.peak_block = max(self.peak_block, len(block))
+            yield block
+        if reader.file is not None:  # how far into the file the stream got
+            self.compressed_bytes = max(self.compressed_bytes, reader.file.tell())
+
+    def count_packets(self, packets):
+        clock = time.perf_counter
+        stats = self.packets
+        callback = self.callback
+        for packet in packets:
+            type = packet[0]
+            self.last_packet = (type, packet[4])
+            start = clock()
+            yield packet
+            elapsed = clock() - start
+            entry = stats.get(type)
+            if entry is None:
+                entry = stats[type] = [0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += packet[3] - packet[2] + 5
+            entry[2] += elapsed
+            if callback is not None:
+                callback(type, packet[4], packet[3] - packet[2] + 5, elapsed)
+        self.last_packet = None
+
+    def count_records(self, records):
+        for record in records:
+            track = record[0]
+            self.records[track.tid] = self.records.get(track.tid, 0) + 1
+            if track.rec_type == 1 or track.rec_type == 6:
+                self.samples[track.tid] = self.samples.get(track.tid, 0) + record[2]
+            else:
+                self.samples[track.tid] = self.samples.get(track.tid, 0) + 1
+            yield record
+        self.exhausted = time.perf_counter()
+
+    def to_dict(self):
+        return {'packets': {self.packet_names.get(t, str(t)): {'count': v[0], 'bytes': v[1], 'seconds': v[2]}
+                            for t, v in self.packets.items()},
+                'records': dict(self.records), 'samples': dict(self.samples),
+                'compressed_bytes': self.compressed_bytes, 'uncompressed_bytes': self.uncompressed_bytes,
+                'decompress_s': self.decompress_s, 'parse_s': self.parse_s, 'finalize_s': self.finalize_s,
+                'total_s': self.total_s, 'peak_block': self.peak_block, 'peak_buffer': self.peak_buffer,
+                'error': self.error, 'last_packet': self.last_packet}
+
+    def summary(self):
+        r = []
+        r.append(['Packet', 'Count', 'Bytes', 'Seconds'])
+        for t in sorted(self.packets):
+            r.append([self.packet_names.get(t, t)] + self.packets[t])
+        return r
+
+# On-disk columnar cache of decoded tracks. Every source file gets a directory named after its
+# path, size and mtime holding one .npy file per track array plus meta.json; entries are reopened
+# with np.memmap and the least recently used ones are evicted once max_bytes is exceeded.
+class vital_cache(object):
+    header_fields = ['signature', 'version', 'headerlen', 'tzbias', 'inst_id', 'prog_ver']
+    device_fields = ['did', 'typename', 'devname', 'port']
+    track_fields = ['tid', 'rec_type', 'rec_fmt', 'name', 'unit', 'minval', 'maxval', 'color', 'srate',
+                    'adc_gain', 'adc_offset', 'mon_type', 'did', 'st']
+    layout = 3  # entries written with another layout are treated as misses and rewritten
+
+    def __init__(self, directory='vital_cache', max_bytes=8 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry_prefix(self, filename):
+        return hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:16]
+
+    def entry(self, filename):
+        stat = os.stat(filename)
+        return os.path.join(self.directory, '%s-%d-%d' % (self.entry_prefix(filename), stat.st_size, stat.st_mtime_ns))
+
+    def load(self, reader):
+        path = self.entry(reader.filename)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return False
+        os.utime(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('layout') != self.layout:
+            return False
+        for key in self.header_fields:
+            setattr(reader, key, meta['header'][key])
+        reader.signature = reader.signature.encode('latin-1')
+        reader.device = {}
+        for d in meta['device']:
+            device = vital_device()
+            for key in self.device_fields:
+                setattr(device, key, d[key].encode('latin-1') if isinstance(d[key], str) else d[key])
+            reader.device[device.did] = device
+        reader.track = {}
+        for t in meta['track']:
+            track = vital_track()
+            for key in self.track_fields:
+                setattr(track, key, t[key].encode('latin-1') if key in ('name', 'unit', 'color') else t[key])
+            for key in ('dt', 'v_number', 'raw'):
+                setattr(track, key, np.load(os.path.join(path, '%s_%d.npy' % (key, track.tid)), mmap_mode='c'))
+            track.v_string = []
+            if track.rec_type == 5:
+                strings = np.load(os.path.join(path, 'v_string_%d.npy' % track.tid)).tobytes()
+                ends = np.cumsum(track.v_number).tolist()
+                track.v_string = [strings[e - n:e] for e, n in zip(ends, track.v_number.tolist())]
+                track.dt = track.dt.tolist()
+                track.v_number = track.v_number.tolist()
+            track.stats = vital_stats.from_dict(t['stats'])
+            reader.track[track.tid] = track
+        return True
+
+    def save(self, reader):
+        path = self.entry(reader.filename)
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            # the source has changed since; .tmp directories are other processes still writing
+            if name.startswith(self.entry_prefix(reader.filename)) and '.tmp' not in name:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        tmp = path + '.tmp%d' % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+        meta = {'layout': self.layout, 'header': {key: getattr(reader, key) for key in self.header_fields},
+                'device': [], 'track': []}
+        meta['header']['signature'] = reader.signature.decode('latin-1')
+        for device in reader.device.values():
+            meta['device'].append({key: getattr(device, key).decode('latin-1') if isinstance(getattr(device, key), bytes)
+                                   else getattr(device, key) for key in self.device_fields})
+        for track in reader.track.values():
+            meta['track'].append({key: getattr(track, key).decode('latin-1') if isinstance(getattr(track, key), bytes)
+                                  else getattr(track, key) for key in self.track_fields})
+            meta['track'][-1]['stats'] = reader.track_stats(track.tid).to_dict()
+            if track.rec_type == 5:
+                np.save(os.path.join(tmp, 'dt_%d.npy' % track.tid), np.array(track.dt, dtype=np.float64))
+                np.save(os.path.join(tmp, 'v_number_%d.npy' % track.tid), np.array(track.v_number, dtype=np.int64))
+                np.save(os.path.join(tmp, 'v_string_%d.npy' % track.tid), np.frombuffer(b''.join(track.v_string), dtype=np.uint8))
+                np.save(os.path.join(tmp, 'raw_%d.npy' % track.tid), np.array([], dtype=np.float32))
+            else:
+                for key in ('dt', 'v_number', 'raw'):
+                    np.save(os.path.join(tmp, '%s_%d.npy' % (key, track.tid)), np.asarray(getattr(track, key)))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)  # another process stored the same entry first
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if '.tmp' in name:
+                continue
+            path = os.path.join(self.directory, name)
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+# State of follow()/poll() on a file that is still being written: the file position and live
+# decompressor after the last poll, the undecoded tail (a partial packet) with its uncompressed
+# offset, and the over-allocated arrays behind the track views.
+class vital_tail(object):
+
+    def __init__(self, tracks=None):
+        self.tracks = tracks
+        self.fpos = 0
+        self.decompressor = None
+        self.buf = b''
+        self.offset = 0
+        self.header = False
+        self.capacity = {}
+        self.callbacks = []
+
+    # Appends values to getattr(track, key), which stays a view of a buffer grown by doubling.
+    def append(self, track, key, values, dtype):
+        current = getattr(track, key)
+        n = len(current)
+        buf = self.capacity.get((track, key))
+        if buf is None or n + len(values) > len(buf):
+            buf = np.empty(max(2 * (n + len(values)), 1024), dtype=dtype)
+            buf[:n] = current
+            self.capacity[(track, key)] = buf
+        buf[n:n + len(values)] = values
+        setattr(track, key, buf[:n + len(values)])
+
 class vital_reader(object):
 
-    def __init__(self,file):
+    def __init__(self, file, decompressor=None):
         self.filename = file
-        self.vital_file = gzip.open(file,"rb")
+        self.decompressor = decompressors[decompressor or default_decompressor]
+        self.file = None
+        self.compressed = None
+        self.truncated = False
+        self.pending = None
         self.device = {}
         self.track = {}
         self.record = []
+        self.index = None
+        self.metrics = None
+        self.tail = None
+
+    # The file is opened once and shared by every reader method; a plain (already decompressed)
+    # .vital file is recognised by the missing gzip magic.
+    def open(self):
+        if self.file is None:
+            self.file = open(self.filename, 'rb')
+            magic = self.file.read(2)
+            self.compressed = magic == b'\x1f\x8b' if len(magic) == 2 else None
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get_gzip_size(self):
-        with open(self.filename, 'rb') as f:
-            f.seek(-4, 2)
-            data = f.read(4)
+        f = self.open()
+        f.seek(-4, 2)
+        data = f.read(4)
         size = struct.unpack('<L', data)[0]
         return size
 
+    # Initial size of the buffer for a whole-file read. The gzip trailer only holds the size of the
+    # last member modulo 4 GiB, so it is used when it is plausible for the compressed size.
+    def buffer_size(self):
+        f = self.open()
+        size = os.fstat(f.fileno()).st_size
+        if not self.compressed:
+            return size
+        isize = self.get_gzip_size()
+        if size <= isize <= size * 1032:
+            return isize
+        return size * 4
+
+    # Reads the header from the first decompressed block and keeps the stream open, so that a
+    # following read_packets() continues from there instead of starting over.
     def read_header(self):
-        with gzip.open(self.filename,"rb") as vital_file:
-            vital_file.seek(0)
-            self.signature = vital_file.read(4)
-            self.version = int.from_bytes(vital_file.read(4), byteorder="little", signed=False)
-            self.headerlen = int.from_bytes(vital_file.read(2), byteorder="little", signed=False)
-            self.tzbias = int.from_bytes(vital_file.read(2), byteorder="little", signed=False)
-            self.inst_id = int.from_bytes(vital_file.read(4), byteorder="little", signed=False)
-            self.prog_ver = int.from_bytes(vital_file.read(4), byteorder="little", signed=False)
+        blocks = self.read_blocks()
+        head = b''
+        for block in blocks:
+            head += block
+            if len(head) >= 20 and len(head) >= 10 + int.from_bytes(head[8:10], byteorder="little", signed=False):
+                break
+        self.parse_header(head)
+        self.pending = (head, blocks)
+
+    def parse_header(self, head):
+        self.signature = bytes(head[0:4])
+        self.version = int.from_bytes(head[4:8], byteorder="little", signed=False)
+        self.headerlen = int.from_bytes(head[8:10], byteorder="little", signed=False)
+        self.tzbias = int.from_bytes(head[10:12], byteorder="little", signed=False)
+        self.inst_id = int.from_bytes(head[12:16], byteorder="little", signed=False)
+        self.prog_ver = int.from_bytes(head[16:20], byteorder="little", signed=False)
 
     def write_track_info(self, filename):
         fieldnames = ['did', 'tid', 'rec_type', 'rec_format', 'name', 'unit', 'minval', 'maxval', 'color', 'srate', 'adc_gain', 'adc_offset', 'mon_type', 'dt_length', 'vn_length']
@@ -97,46 +981,21 @@ class vital_reader(object):
                 csv_writer.writerow([self.device[idevice].did, self.device[idevice].typename,
                                      self.device[idevice].devname, self.device[idevice].port])
     def analyze_dt(self, filename):
-        fieldnames = []
-        firstrow = {}
-        max_len_dt = 0
-        for itrack in self.track:
-            fieldnames.append(itrack)
-            firstrow[itrack] = self.track[itrack].dt[0]
-            if (max_len_dt < len(self.track[itrack].dt)):
-                max_len_dt = len(self.track[itrack].dt)
-        with open(filename, 'w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting = csv.QUOTE_MINIMAL)
-            csv_writer.writerow(fieldnames)
-            for i in range(max_len_dt):
-                row = []
-                for itrack in self.track:
-                    if ( i < len(self.track[itrack].dt) ):
-                        row.append(self.track[itrack].dt[i] - firstrow[itrack])
-                    else:
-                        row.append(0)
-                csv_writer.writerow(row)
+        self.write_record_table(filename, lambda t_track: np.asarray(t_track.dt) - t_track.dt[0])
 
     def analyze_length(self, filename):
-        fieldnames = []
-        firstrow = {}
-        max_len_dt = 0
-        for itrack in self.track:
-            fieldnames.append(itrack)
-            firstrow[itrack] = self.track[itrack].dt[0]
-            if (max_len_dt < len(self.track[itrack].dt)):
-                max_len_dt = len(self.track[itrack].dt)
+        self.write_record_table(filename, lambda t_track: t_track.v_number)
+
+    # One column per track (headed by its tid) and one row per record; shorter tracks are padded with 0.
+    def write_record_table(self, filename, column, chunk_size=1 << 16):
+        columns = [column(self.track[itrack]) for itrack in self.track]
+        max_len_dt = max([len(self.track[itrack].dt) for itrack in self.track] + [0])
         with open(filename, 'w', newline='') as csvfile:
             csv_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting = csv.QUOTE_MINIMAL)
-            csv_writer.writerow(fieldnames)
-            for i in range(max_len_dt):
-                row = []
-                for itrack in self.track:
-                    if ( i < len(self.track[itrack].dt) ):
-                        row.append(self.track[itrack].v_number[i])
-                    else:
-                        row.append(0)
-                csv_writer.writerow(row)
+            csv_writer.writerow(list(self.track))
+            for i in range(0, max_len_dt, chunk_size):
+                n = min(chunk_size, max_len_dt - i)
+                write_csv_columns(csvfile, [format_values(c[i:i + n]) + ['0'] * (n - len(c[i:i + n])) for c in columns])
 
     def read_value_csv_form(self, typename, trackname):
         did = 0
@@ -154,105 +1013,117 @@ class vital_reader(object):
                 return r
         raise ValueError('No such a track exists.')
 
+    # One [dt, value] row per sample; dt is the segment start time on the first sample of each
+    # segment and 0 elsewhere.
     def read_wave_csv_form(self, typename, trackname):
-        did = 0
-        r = []
-        if typename != '':
-            for idevice in self.device:
-                if self.device[idevice].typename.decode('utf-8') == typename:
-                    did = self.device[idevice].did
-            if did==0:
-                raise ValueError('No such a device exists.')
-        for itrack in self.track:
-            if self.track[itrack].name.decode('utf-8') == trackname and self.track[itrack].did == did:
-                last_p = 0
-                for vi in range(len(self.track[itrack].v_number)):
-                    for i in range(self.track[itrack].v_number[vi]):
-                        if i == 0:
-                            if last_p == 0:
-                                r.append([self.track[itrack].dt[i], self.track[itrack].v_wave[last_p + i]])
-                            elif abs(self.track[itrack].dt[i] - self.track[itrack].dt[i-1] + self.track[itrack].v_number[i-1] / self.track[itrack].srate) < 1.0:
-                                r.append([self.track[itrack].dt[i], self.track[itrack].v_wave[last_p + i]])
-                            else:
-                                r.append([0, self.track[itrack].v_wave[last_p + i]])
-                        else:
-                            r.append([0, self.track[itrack].v_wave[last_p + i]])
-                    last_p = last_p + self.track[itrack].v_number[vi]
-                return r
-        raise ValueError('No such a track exists.')
+        t_track = self.read_track(typename, trackname)
+        segments = t_track.get_segments()
+        markers = [0] * int(segments.offsets[-1])
+        for i in range(len(segments)):
+            if segments.start[i] < segments.end[i]:
+                markers[segments.start[i]] = float(segments.start_dt[i])
+        return [[dt, value] for dt, value in zip(markers, t_track.wave(0, len(markers)))]
 
     # Assumes that there's no duplicated track name. Needs to be changed.
 
-    def read_wave_datetime_interval(self, typename, trackname, datetime_start, datetime_end):
-        dt, wave_val = self.read_wave_datetime(typename, trackname)
-        p_start = 0
-        while dt[p_start] < datetime_start if p_start < len(dt) else False:
-            p_start += 1
-        p_end = p_start
-        while dt[p_end] < datetime_end if p_end < len(dt) else False:
-            p_end += 1
+    def read_wave_datetime_interval(self, typename, trackname, datetime_start, datetime_end, tz=None):
+        t_start = datetime_to_epoch(datetime_start, tz)
+        t_end = datetime_to_epoch(datetime_end, tz)
+        t_track = self.read_track(typename, trackname)
+        if self.index is not None:
+            t_track = self.load_interval([(typename, trackname)], t_start, t_end)[t_track.tid]
+        t, wave_val = self.track_wave_utc(t_track, t_start, t_end)
+        return epoch_to_datetime64(t, tz), wave_val
 
-        if p_start < p_end:
-            return dt[p_start:p_end], wave_val[p_start:p_end]
-        return [], []
+    def read_wave_datetime(self, typename, trackname, tz=None):
+        t, wave_val = self.read_wave_utc(typename, trackname)
+        return epoch_to_datetime64(t, tz), wave_val
 
-    def read_wave_datetime(self, typename, trackname):
-        wave, srate = self.read_wave(typename, trackname)
-        dt = []
-        val = []
+    # Sample times (UTC seconds) and a view of the samples of a wave track, limited to
+    # [t_start, t_end) when given. Only the times of the returned samples are computed.
+    def read_wave_utc(self, typename, trackname, t_start=None, t_end=None):
+        return self.track_wave_utc(self.read_track(typename, trackname), t_start, t_end)
 
-        for i in range(len(wave)):
-            for j in range(len(wave[i][1])):
-                dt.append(datetime.datetime.fromtimestamp(wave[i][0]+j/srate))
-                val.append(wave[i][1][j])
+    def track_wave_utc(self, t_track, t_start=None, t_end=None):
+        segments = t_track.get_segments()
+        p_start = 0 if t_start is None else segments.bound(t_start)
+        p_end = int(segments.offsets[-1]) if t_end is None else max(p_start, segments.bound(t_end))
+        return segments.times(p_start, p_end), t_track.wave(p_start, p_end)
 
-        return dt, val
+    def read_wave(self, typename, trackname, tolerance=1.0):
+        t_track = self.read_track(typename, trackname)
+        return t_track.get_segments(tolerance).views(t_track), t_track.srate
 
-    def read_wave(self, typename, trackname):
-        did = 0
-        r = []
-        if typename != '':
-            for idevice in self.device:
-                if self.device[idevice].typename.decode('utf-8') == typename:
-                    did = self.device[idevice].did
-            if did==0:
-                raise ValueError('No such a device exists.')
-        for itrack in self.track:
-            if self.track[itrack].name.decode('utf-8') == trackname and self.track[itrack].did == did:
-                t_track = self.track[itrack]
-                start_p = 0
-                last_p = t_track.v_number[0]
-                start_dt = t_track.dt[0]
-                for vi in range(1, len(t_track.v_number)):
-                    if abs(t_track.dt[vi] - t_track.dt[vi-1] - t_track.v_number[vi-1] / t_track.srate) > 1.0:
-                        print ("new segment was found.", vi, t_track.dt[vi], t_track.dt[vi-1], t_track.v_number[vi-1], t_track.srate)
-                        r.append([start_dt, self.track[itrack].v_wave[start_p:last_p]]) # add a vector
-                        start_dt = self.track[itrack].dt[vi]
-                        start_p = last_p
-                    last_p = last_p + self.track[itrack].v_number[vi]
-                r.append([start_dt, self.track[itrack].v_wave[start_p:last_p]])  # add a vector
-                return r, self.track[itrack].srate
-        raise ValueError('No such a track exists.')
+    # Yields (t, chunk) with the UTC times of up to chunk_size points of the grid t_start + k / srate
+    # in [t_start, t_end) and a float32 matrix holding one column per (typename, trackname) pair.
+    def iter_aligned(self, tracks, srate, t_start, t_end, fill='last', chunk_size=1 << 16):
+        t_tracks = [self.read_track(typename, trackname) for typename, trackname in tracks]
+        return self.iter_aligned_tracks(t_tracks, srate, t_start, t_end, fill, chunk_size)
 
-    def read_number_datetime_interval(self, typename, trackname, datetime_start, datetime_end):
-        dt, number = self.read_number_datetime(typename, trackname)
-        p_start = 0
-        while dt[p_start] < datetime_start if p_start < len(dt) else False:
-            p_start += 1
-        p_end = p_start
-        while dt[p_end] < datetime_end if p_end < len(dt) else False:
-            p_end += 1
+    def iter_aligned_tracks(self, t_tracks, srate, t_start, t_end, fill='last', chunk_size=1 << 16):
+        for t_track in t_tracks:
+            if t_track.rec_type not in (1, 2, 6):
+                raise ValueError('Only wave and number tracks can be aligned.')
+        n = max(int(np.ceil((t_end - t_start) * srate)), 0)
+        for k in range(0, n, chunk_size):
+            t = t_start + np.arange(k, min(k + chunk_size, n)) / srate
+            chunk = np.empty((len(t), len(t_tracks)), dtype=np.float32)
+            for j, t_track in enumerate(t_tracks):
+                if t_track.rec_type == 2:
+                    chunk[:, j] = resample_number(t_track.dt, t_track.v_number, t, fill)
+                else:
+                    chunk[:, j] = resample_wave(t_track, t, srate)
+            yield t, chunk
 
-        if p_start < p_end:
-            return dt[p_start:p_end], number[p_start:p_end]
-        return [],[]
+    def read_aligned(self, tracks, srate, datetime_start, datetime_end, fill='last', tz=None, chunk_size=1 << 16):
+        t_start = datetime_to_epoch(datetime_start, tz)
+        t_end = datetime_to_epoch(datetime_end, tz)
+        t_tracks = [self.read_track(typename, trackname) for typename, trackname in tracks]
+        if self.index is not None:
+            # numeric tracks need the value before the window for fill='last'
+            loaded = self.load_interval(tracks, t_start, t_end, previous=True)
+            t_tracks = [loaded[t_track.tid] for t_track in t_tracks]
+        n = max(int(np.ceil((t_end - t_start) * srate)), 0)
+        t = np.empty(n, dtype=np.float64)
+        matrix = np.empty((n, len(tracks)), dtype=np.float32)
+        pos = 0
+        for t_chunk, chunk in self.iter_aligned_tracks(t_tracks, srate, t_start, t_end, fill, chunk_size):
+            t[pos:pos + len(t_chunk)] = t_chunk
+            matrix[pos:pos + len(t_chunk)] = chunk
+            pos += len(t_chunk)
+        return epoch_to_datetime64(t, tz), matrix
 
-    def read_number_datetime(self, typename, trackname):
+    # At most n (t, vmin, vmax, vmean) points for plotting the wave between t_start and t_end (UTC
+    # seconds), taken from the pyramid level that fits. Works on pyramids from open_pyramids alone.
+    def read_wave_display(self, typename, trackname, t_start=None, t_end=None, n=2000):
+        t_track = self.read_track(typename, trackname)
+        return t_track.get_pyramid().query(t_track, t_start, t_end, n)
+
+    def gap_report(self, typename, trackname, tolerance=1.0):
+        t_track = self.read_track(typename, trackname)
+        segments = t_track.get_segments(tolerance)
+        r = [['Start', 'End', 'Samples', 'Gap']]
+        for i in range(len(segments)):
+            n = int(segments.end[i] - segments.start[i])
+            start_dt = float(segments.start_dt[i])
+            r.append([start_dt, start_dt + n / t_track.srate, n, float(segments.gap[i])])
+        return r
+
+    def read_number_datetime_interval(self, typename, trackname, datetime_start, datetime_end, tz=None):
+        t_start = datetime_to_epoch(datetime_start, tz)
+        t_end = datetime_to_epoch(datetime_end, tz)
+        t_track = self.read_track(typename, trackname)
+        if self.index is not None:
+            t_track = self.load_interval([(typename, trackname)], t_start, t_end)[t_track.tid]
+        dt, number = t_track.dt, t_track.v_number
+        dt = np.asarray(dt, dtype=np.float64)
+        p_start, p_end = np.searchsorted(dt, [t_start, t_end])
+        p_end = max(p_start, p_end)
+        return epoch_to_datetime64(dt[p_start:p_end], tz), number[p_start:p_end]
+
+    def read_number_datetime(self, typename, trackname, tz=None):
         dt, number = self.read_number_utc(typename, trackname)
-        new_dt = []
-        for i in range(len(dt)):
-            new_dt.append(datetime.datetime.fromtimestamp(dt[i]))
-        return new_dt, number
+        return epoch_to_datetime64(dt, tz), number
 
     def read_number_utc(self, typename, trackname):
         did = 0
@@ -301,145 +1172,622 @@ class vital_reader(object):
                 return self.track[itrack]
         raise ValueError('No such a track exists.')
 
-    def read_packets(self):
-        i = 0
-        try:
-            with gzip.open(self.filename, "rb") as vital_file:
-                while True:
-                    if (i == 0):
-                        vital_file.read(10 + self.headerlen)
-#                    print("Iteration : ", i)
-                    type = int.from_bytes(vital_file.read(1), byteorder="little", signed=False)
-                    datalen = int.from_bytes(vital_file.read(4), byteorder="little", signed=False)
-#                    print("Type : ", type, "\tData Length : ", datalen, "\tFile Pointer : ", vital_file.tell())
-                    if ( datalen == 0 ):
-#                        print ("Packet with 0 length was found. Ignoring.")
-                        break
+    # start is a (compressed offset, uncompressed offset, decompressor) restart point; a None
+    # decompressor means a gzip member (or, for a plain file, the data itself) begins there. When
+    # checkpoints is a list, a restart point is appended at every member and roughly every
+    # spacing bytes of output. self.truncated is set when the stream ends inside a member.
+    def read_blocks(self, blocksize=1 << 20, start=None, checkpoints=None, spacing=1 << 20):
+        blocks = self.inflate_blocks(blocksize, start, checkpoints, spacing)
+        return blocks if self.metrics is None else self.metrics.count_blocks(blocks, self)
+
+    def inflate_blocks(self, blocksize, start, checkpoints, spacing):
+        f = self.open()
+        if start is None:
+            self.truncated = False
+        comp, uncomp, decompressor = (0, 0, None) if start is None else start
+        if isinstance(decompressor, deflate_point):
+            value = 0
+            if decompressor.bits:
+                f.seek(comp - 1)
+                value = f.read(1)[0]
+            decompressor = decompressor.inflater(value)
+        elif decompressor is not None:
+            decompressor = decompressor.copy()
+        next_checkpoint = uncomp + spacing
+        fpos = comp
+        data = b''
+        while True:
+            if not data:
+                f.seek(fpos)
+                data = f.read(blocksize)
+                fpos += len(data)
+                if not data:
+                    break
+            if not self.compressed:
+                if checkpoints is not None and (not checkpoints or uncomp >= next_checkpoint):
+                    checkpoints.append((comp, uncomp, None))
+                    next_checkpoint = uncomp + spacing
+                comp += len(data)
+                uncomp += len(data)
+                yield data
+                data = b''
+                continue
+            if decompressor is None:
+                if checkpoints is None:
+                    decompressor = self.decompressor()
+                elif libz is not None:
+                    decompressor = block_inflater(spacing=spacing)
+                else:
+                    # restart points without libz need decompressobj.copy(), which only zlib provides
+                    decompressor = zlib_decompressor()
+                if checkpoints is not None:
+                    checkpoints.append((comp, uncomp, None))
+                    member = (comp, uncomp)
+            block = decompressor.decompress(data)
+            comp += len(data) - len(decompressor.unused_data)
+            uncomp += len(block)
+            if checkpoints is not None and isinstance(decompressor, block_inflater):
+                for point in decompressor.points:
+                    checkpoints.append((member[0] + point[0], member[1] + point[2], deflate_point(point[1], point[3])))
+                del decompressor.points[:]
+            if block:
+                yield block
+            data = b''
+            if decompressor.eof:  # next gzip member
+                data = decompressor.unused_data.lstrip(b'\x00')
+                comp += len(decompressor.unused_data) - len(data)
+                decompressor = None
+            elif checkpoints is not None and not isinstance(decompressor, block_inflater) and uncomp >= next_checkpoint:
+                checkpoints.append((comp, uncomp, decompressor.copy()))
+                next_checkpoint = uncomp + spacing
+        if decompressor is not None:
+            self.truncated = True
+
+    # Collects blocks into one buffer preallocated from buffer_size().
+    def read_all(self, blocks):
+        buf = bytearray(self.buffer_size())
+        n = 0
+        for block in blocks:
+            if n + len(block) > len(buf):
+                buf.extend(bytearray(max(n + len(block) - len(buf), len(buf) // 2)))
+            buf[n:n + len(block)] = block
+            n += len(block)
+        del buf[n:]
+        return buf
+
+    # Yields (type, buffer view, payload start, payload end, packet offset) for every complete
+    # packet. offset is the uncompressed offset of the first packet to return and start the restart
+    # point to inflate from (see read_blocks); by default the stream is read from the first packet
+    # on, continuing after read_header(). buffered decompresses the whole stream into one buffer first.
+    def iter_packets(self, offset=None, start=None, checkpoints=None, spacing=1 << 20, buffered=False):
+        blocksize = 1 << 20 if checkpoints is None else 1 << 16
+        if offset is None and start is None and getattr(self, 'headerlen', None) is None:
+            self.read_header()
+        pending, self.pending = self.pending, None
+        if offset is None and start is None and checkpoints is None and pending is not None:
+            blocks = itertools.chain([pending[0]], pending[1])
+        else:
+            blocks = self.read_blocks(blocksize, start, checkpoints, spacing)
+        metrics = self.metrics
+        if buffered:
+            blocks = [self.read_all(blocks)]
+            if metrics is not None:
+                metrics.peak_buffer = max(metrics.peak_buffer, len(blocks[0]))
+        buf = b''
+        pos = 0
+        base = 0 if start is None else start[1]
+        skip = 10 + self.headerlen if offset is None else offset
+        for block in blocks:
+            base += pos
+            buf = buf[pos:] + block if pos < len(buf) else block
+            pos = 0
+            if skip is not None:
+                if base + len(buf) < skip:
+                    pos = len(buf)
+                    continue
+                pos, skip = skip - base, None
+            end = len(buf)
+            if metrics is not None:
+                metrics.peak_buffer = max(metrics.peak_buffer, end)
+            view = memoryview(buf)
+            while pos + 5 <= end:
+                type, datalen = struct.unpack_from('<BL', buf, pos)
+                if datalen == 0:
+#                    print ("Packet with 0 length was found. Ignoring.")
+                    return
+                if pos + 5 + datalen > end:
+                    break
+                yield type, view, pos + 5, pos + 5 + datalen, base + pos
+                pos += 5 + datalen
+        if pos < len(buf):
+            self.truncated = True
+
+    # Metadata goes to self.track/self.device unless other dicts are given.
+    def parse_trkinfo(self, buf, pos, end, tracks=None):
+        packet_data = io.BytesIO(buf[pos:end])
+        track = vital_track()
+        track.tid = int.from_bytes(packet_data.read(2), byteorder="little", signed=False)
+        track.rec_type = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
+        track.rec_fmt = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
+        track.name = packet_data.read(
+            int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
+        track.unit = packet_data.read(
+            int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
+        track.minval = struct.unpack('<f', packet_data.read(4))[0]
+        track.maxval = struct.unpack('<f', packet_data.read(4))[0]
+        track.color = packet_data.read(4)
+        track.srate = struct.unpack('<f', packet_data.read(4))[0]
+        track.adc_gain = struct.unpack('<d', packet_data.read(8))[0]
+        track.adc_offset = struct.unpack('<d', packet_data.read(8))[0]
+        track.mon_type = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
+        track.did = int.from_bytes(packet_data.read(4), byteorder="little", signed=False)
+        (self.track if tracks is None else tracks)[track.tid] = track
+        return track
+
+    def parse_devinfo(self, buf, pos, end, devices=None):
+        packet_data = io.BytesIO(buf[pos:end])
+        device = vital_device()
+        device.did = int.from_bytes(packet_data.read(4), byteorder="little", signed=False)
+        device.typename = packet_data.read(
+            int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
+        device.devname = packet_data.read(
+            int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
+        device.port = packet_data.read(
+            int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
+        (self.device if devices is None else devices)[device.did] = device
+        return device
+
+    def get_typename(self, did):
+        if did == 0 or did not in self.device:
+            return ''
+        return self.device[did].typename.decode('utf-8')
+
+    def list_tracks(self):
+        return [(self.get_typename(self.track[itrack].did), self.track[itrack].name.decode('utf-8')) for itrack in self.track]
+
+    # tracks is a list of (typename, trackname) pairs; trackname None selects every track of the device.
+    def is_selected(self, tid, tracks):
+        if tid not in self.track:
+            return True
+        typename = self.get_typename(self.track[tid].did)
+        return (typename, self.track[tid].name.decode('utf-8')) in tracks or (typename, None) in tracks
+
+    def read_metadata(self):
+        self.read_packets(metadata_only=True)
+
+    # Yields (track, dt, number, data) for every SAVE_REC of the selected tracks, where number is
+    # the sample count, the numeric value or the string length and data holds the raw samples (a
+    # memoryview into the decompressed block, valid for as long as it is referenced) or the string.
+    # Metadata packets update self.device and self.track on the way; nothing else is kept.
+    def iter_records(self, tracks=None, metadata_only=False, record=None, packets=None):
+        selected = {}
+        if packets is None:
+            packets = self.iter_packets()
+        for type, buf, pos, end, offset in packets:
+            if (type == 0):  # SAVE_TRKINFO
+                self.parse_trkinfo(buf, pos, end)
+                selected.clear()
+            elif (type == 1):  # SAVE_REC
+                if metadata_only:
+                    continue
+                if tracks is not None:
+                    tid = struct.unpack_from('<H', buf, pos + 10)[0]
+                    keep = selected.get(tid)
+                    if keep is None:
+                        keep = selected[tid] = self.is_selected(tid, tracks)
+                    if not keep:
+                        continue
+                infolen, dt, tid = struct.unpack_from('<HdH', buf, pos)
+                track = self.track.get(tid)
+                if (track is None or track.did == ""):
+                    raise ValueError('Undefined track id was found in a record packet. Track : %d' % tid)
+                if (track.rec_type == 1 or track.rec_type == 6):  # Wave
+                    number = struct.unpack_from('<L', buf, pos + 12)[0]
+                    dtype = wave_dtype.get(track.rec_fmt)
+                    data = None if dtype is None else buf[pos + 16:pos + 16 + dtype.itemsize * number]
+                elif (track.rec_type == 2):  # Number
+                    if (track.rec_fmt == 1):  # FMT_FLOAT
+                        number = struct.unpack_from('<f', buf, pos + 12)[0]
+                        data = None
+                    else:
+                        raise ValueError('Unknown Format, add codes. Track : %d, Format : %d' % (tid, track.rec_fmt))
+                elif (track.rec_type == 5):  # String
+                    slen = struct.unpack_from('<L', buf, pos + 16)[0]
+                    data = buf[pos + 20:min(pos + 20 + slen, end)].tobytes()
+                    number = len(data)
+                else:
+                    raise ValueError('Unknown Record Type. Track : %d, Type : %d' % (tid, track.rec_type))
+                if record is not None:
+                    rec = vital_record()
+                    rec.infolen = infolen
+                    rec.dt = dt
+                    rec.tid = tid
+                    if track.rec_type == 2:
+                        rec.data = [number]
+                    elif track.rec_type != 5 and track.rec_fmt == 1 and data is not None:
+                        rec.data = np.frombuffer(data, dtype=wave_dtype[1])
                     else:
-                        packet_data = io.BytesIO(vital_file.read(datalen))
-                        if (type == 0):  # SAVE_TRKINFO
-                            tid = int.from_bytes(packet_data.read(2), byteorder="little", signed=False)
-                            self.track[tid] = vital_track()
-                            self.track[tid].tid = tid
-                            self.track[tid].rec_type = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
-                            self.track[tid].rec_fmt = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
-                            self.track[tid].name = packet_data.read(
-                                int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
-                            self.track[tid].unit = packet_data.read(
-                                int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
-                            self.track[tid].minval = struct.unpack('<f', packet_data.read(4))[0]
-                            self.track[tid].maxval = struct.unpack('<f', packet_data.read(4))[0]
-                            self.track[tid].color = packet_data.read(4)
-                            self.track[tid].srate = struct.unpack('<f', packet_data.read(4))[0]
-                            self.track[tid].adc_gain = struct.unpack('<d', packet_data.read(8))[0]
-                            self.track[tid].adc_offset = struct.unpack('<d', packet_data.read(8))[0]
-                            self.track[tid].mon_type = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
-                            self.track[tid].did = int.from_bytes(packet_data.read(4), byteorder="little", signed=False)
-                            self.track[tid].dt = []
-                            self.track[tid].v_number = []
-                            self.track[tid].v_wave = []
-                            self.track[tid].v_string = []
-#                            print("Track append complete", tid)
-                        elif (type == 1):  # SAVE_REC
-#                            print("Save Record")
-                            rec = vital_record()
-                            rec.infolen = int.from_bytes(packet_data.read(2), byteorder="little", signed=False)
-                            rec.dt = struct.unpack('<d', packet_data.read(8))[0]
-                            rec.tid = int.from_bytes(packet_data.read(2), byteorder="little", signed=False)
-                            if (self.track[rec.tid].did == ""):
-                                print("Undefined track id was found in a record packet.")
-                                exit(1)
-                            if (len(self.track[rec.tid].dt) != len(self.track[rec.tid].v_number)):
-                                print("Vector size is wrong. Track : ", rec.tid)
-                                exit(1)
-                            if (self.track[rec.tid].rec_type == 1 or self.track[rec.tid].rec_type == 6):  # Wave
-#                                print("wave")
-                                num = int.from_bytes(packet_data.read(4), byteorder="little", signed=False)
-                                self.track[rec.tid].dt.append(rec.dt)
-                                self.track[rec.tid].v_number.append(num)
-                                if (self.track[rec.tid].st == 0):
-                                    self.track[rec.tid].st = rec.dt
-#                                else:
-#                                    if len(self.track[rec.tid].dt) >= 2:
-#                                        if (abs((rec.dt - self.track[rec.tid].dt[-2]) - num / self.track[rec.tid].srate) >= 3):
-#                                            print("Time gap is more than 3 second in the wave type track.")
-                                rec.data = []
-
-                                if (self.track[rec.tid].rec_fmt == 1):
-                                    listval = list(struct.unpack('<'+'f'*num,packet_data.read(4*num)))
-                                    rec.data.extend(listval)
-                                    self.track[rec.tid].v_wave.extend(listval)
-                                elif (self.track[rec.tid].rec_fmt == 5 or self.track[rec.tid].rec_fmt == 6):
-                                    self.track[rec.tid].v_string.append(packet_data.read(2*num))
-                                    listval = list(struct.unpack('<'+'h'*num,self.track[rec.tid].v_string[-1]))
-                                    for p in range(len(listval)):
-                                        self.track[rec.tid].v_wave.append(listval[p] * self.track[rec.tid].adc_gain + self.track[rec.tid].adc_offset )
-
-                            elif (self.track[rec.tid].rec_type == 2):  # Number
-#                                print("number")
-#                                print(self.track[rec.tid].rec_fmt)
-                                if (self.track[rec.tid].rec_fmt == 1):  # FMT_FLOAT
-#                                    print("FMT_FLOAT")
-                                    value = struct.unpack('<f', packet_data.read(4))[0]
-                                    self.track[rec.tid].dt.append(rec.dt)
-                                    self.track[rec.tid].v_number.append(value)
-#                                    print(value)
-                                    rec.data.append(value)
-                                else:
-                                    print("Unknown Format, add codes")
-                                    exit(1)
-                            elif (self.track[rec.tid].rec_type == 5):  # String
-                                self.track[rec.tid].dt.append(rec.dt)
-                                int.from_bytes(packet_data.read(4), byteorder="little", signed=False)
-                                sval = packet_data.read(int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
-                                self.track[rec.tid].v_number.append(len(sval))
-                                self.track[rec.tid].v_string.append(sval)
-                            else:
-                                print("Unknown Record Type")
-                                exit(1)
-                            self.record.append(rec)
-
-                        elif (type == 6):  # SAVE_CMD
-                            cmd = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
-                            if (cmd == 5):  # CMD_ORDER
-                                cnt = int.from_bytes(packet_data.read(2), byteorder="little", signed=False)
-                                tv = []
-#                                print("CMD ORDER")
-                                for i in range(cnt):
-                                    tv.append(int.from_bytes(packet_data.read(2), byteorder="little", signed=False))
-#                                print(tv)
-                            elif (cmd == 6):  # CMD_RESET_EVENTS
-                                print("Reset Events : code required")
-                                # Do nothing
-                            else:
-                                print("Error. Unknown Command")
-                                print(cmd)
-                                exit(1)
-                        elif (type == 9):  # SAVE_DEVINFO
-                            device = vital_device()
-                            device.did = int.from_bytes(packet_data.read(4), byteorder="little", signed=False)
-                            device.typename = packet_data.read(
-                                int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
-                            device.devname = packet_data.read(
-                                int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
-                            device.port = packet_data.read(
-                                int.from_bytes(packet_data.read(4), byteorder="little", signed=False))
-                            self.device[device.did] = device
-#                            print("Devinfo append complete")
-                    i += 1
-
-        except EOFError as e:
-            print("Ignoring EOF Error.")
-            print(e)
+                        rec.data = []
+                    record.append(rec)
+                yield track, dt, number, data
+
+            elif (type == 6):  # SAVE_CMD
+                packet_data = io.BytesIO(buf[pos:end])
+                cmd = int.from_bytes(packet_data.read(1), byteorder="little", signed=False)
+                if (cmd == 5):  # CMD_ORDER
+                    cnt = int.from_bytes(packet_data.read(2), byteorder="little", signed=False)
+                    tv = []
+                    for i in range(cnt):
+                        tv.append(int.from_bytes(packet_data.read(2), byteorder="little", signed=False))
+                elif (cmd == 6):  # CMD_RESET_EVENTS
+                    print("Reset Events : code required")
+                    # Do nothing
+                else:
+                    raise ValueError('Unknown Command : %d' % cmd)
+            elif (type == 9):  # SAVE_DEVINFO
+                self.parse_devinfo(buf, pos, end)
+                selected.clear()
+
+    # Streams (tid, dt, samples) per record without storing anything on the tracks. Wave samples
+    # are scaled float32 arrays (a read-only view of the decompressed block for rec_fmt 1), numbers
+    # come as one-element arrays and strings as bytes.
+    def iter_chunks(self, tracks=None):
+        for track, dt, number, data in self.iter_records(tracks):
+            samples = chunk_samples(track, number, data)
+            if samples is not None:
+                yield track.tid, dt, samples
+
+    # Starts following a file that is still being recorded: tracks are rebuilt from the beginning
+    # and every poll() decodes only what was appended since the previous one.
+    def follow(self, tracks=None):
+        callbacks = self.tail.callbacks if self.tail is not None else []
+        self.tail = vital_tail(tracks)
+        self.tail.callbacks = callbacks
+        self.device = {}
+        self.track = {}
+        return self.poll()
+
+    # callback(tid, dt, samples) is called for every record decoded by poll(), with the same
+    # samples as iter_chunks.
+    def add_callback(self, callback):
+        if self.tail is None:
+            self.tail = vital_tail()
+        self.tail.callbacks.append(callback)
+
+    # Decodes the packets appended since the last poll and returns how many records were added.
+    def poll(self):
+        tail = self.tail
+        f = self.open()
+        size = os.fstat(f.fileno()).st_size
+        if size < tail.fpos:  # the file was replaced
+            return self.follow(tail.tracks)
+        f.seek(tail.fpos)
+        data = f.read(size - tail.fpos)
+        if self.compressed is None:
+            if len(data) < 2:
+                return 0
+            self.compressed = data[:2] == b'\x1f\x8b'
+        tail.fpos += len(data)
+        if not self.compressed:
+            out = [data]
+        else:
+            out = []
+            while data:
+                if tail.decompressor is None:
+                    data = data.lstrip(b'\x00')
+                    if not data:
+                        break
+                    tail.decompressor = self.decompressor()
+                out.append(tail.decompressor.decompress(data))
+                data = b''
+                if tail.decompressor.eof:  # next gzip member
+                    data = tail.decompressor.unused_data
+                    tail.decompressor = None
+        buf = tail.buf + b''.join(out)
+        pos = 0
+        if not tail.header:
+            if len(buf) < 20 or len(buf) < 10 + int.from_bytes(buf[8:10], byteorder="little", signed=False):
+                tail.buf = buf
+                return 0
+            self.parse_header(buf)
+            tail.header = True
+            pos = 10 + self.headerlen
+        packets = []
+        view = memoryview(buf)
+        while pos + 5 <= len(buf):
+            type, datalen = struct.unpack_from('<BL', buf, pos)
+            if pos + 5 + datalen > len(buf):
+                break
+            if datalen:
+                packets.append((type, view, pos + 5, pos + 5 + datalen, tail.offset + pos))
+            pos += 5 + datalen
+        tail.buf = buf[pos:]
+        tail.offset += pos
+        return self.append_records(self.iter_records(tail.tracks, packets=packets))
+
+    def append_records(self, records):
+        tail = self.tail
+        new = {}
+        count = 0
+        for track, dt, number, data in records:
+            count += 1
+            if track not in new:
+                new[track] = ([], [], [])
+            new[track][0].append(dt)
+            new[track][1].append(number)
+            new[track][2].append(data)
+            if track.rec_type != 2 and track.rec_type != 5 and track.st == 0:
+                track.st = dt
+            for callback in tail.callbacks:
+                samples = chunk_samples(track, number, data)
+                if samples is not None:
+                    callback(track.tid, dt, samples)
+        for track in new:
+            dt, number, data = new[track]
+            if track.stats is None:
+                track.stats = vital_stats()
+            if track.rec_type == 5:
+                track.dt.extend(dt)
+                track.v_number.extend(number)
+                track.v_string.extend(data)
+                track.stats.update(track, dt, number)
+                continue
+            tail.append(track, 'dt', dt, np.float64)
+            if track.rec_type == 2:
+                tail.append(track, 'v_number', number, np.float32)
+                if isinstance(track.raw, list):
+                    track.raw = np.array([], dtype=np.float32)
+                track.stats.update(track, dt, number, np.array(number, dtype=np.float32))
+            else:
+                tail.append(track, 'v_number', number, np.int32)
+                raw = decode_wave(track, [d for d in data if d is not None])
+                tail.append(track, 'raw', raw, raw.dtype)
+                track.stats.update(track, dt, number, raw)
+        self.finalize_tracks({})
+        return count
+
+    # Returns self.metrics, which is None unless the reader was instrumented. Only a full decode
+    # inflates the whole stream at once; metadata or a track selection streams it block by block.
+    def read_packets(self, tracks=None, metadata_only=False, store_records=True, pyramids=False):
+        record = self.record if store_records else None
+        metrics = self.metrics
+        buffered = not metadata_only and tracks is None
+        if metrics is None:
+            self.collect(self.iter_records(tracks, metadata_only, record, self.iter_packets(buffered=buffered)), copy=not buffered)
+        else:
+            start = time.perf_counter()
+            decompress_s = metrics.decompress_s
+            try:
+                records = self.iter_records(tracks, metadata_only, record, metrics.count_packets(self.iter_packets(buffered=buffered)))
+                self.collect(metrics.count_records(records), copy=not buffered)
+                metrics.finalize_s += time.perf_counter() - metrics.exhausted
+            except Exception as e:
+                metrics.error = '%s: %s' % (type(e).__name__, e)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.total_s += elapsed
+                metrics.parse_s += elapsed - (metrics.decompress_s - decompress_s)
+        if pyramids and not metadata_only:
+            self.build_pyramids(save=False)
+        return metrics
 
+    # Collects vital_metrics for the following parses, calling callback(type, offset, length, seconds)
+    # after every packet; call it before read_header() so that the first blocks are counted too.
+    # instrument(enabled=False) turns it off again.
+    def instrument(self, callback=None, enabled=True):
+        self.metrics = vital_metrics(callback) if enabled else None
+        return self.metrics
+
+    # Reopens the decoded tracks from the cache when the source file is unchanged; otherwise parses
+    # the whole file and stores it there.
+    def read_packets_cached(self, cache=None):
+        if cache is None:
+            cache = vital_cache()
+        if cache.load(self):
+            return
+        self.read_header()
+        self.read_packets(store_records=False)
+        cache.save(self)
+
+    # Accumulates iter_records output on the tracks (self.track unless another dict is given).
+    # Wave payloads are copied unless copy is False: a view into a streamed block would keep the
+    # whole block alive until the end of the parse. Views are only kept when the whole stream is
+    # buffered anyway.
+    def collect(self, records, tracks=None, copy=True):
+        wave_parts = {}
+        for track, dt, number, data in records:
+            track.dt.append(dt)
+            track.v_number.append(number)
+            if track.rec_type == 5:
+                track.v_string.append(data)
+            elif track.rec_type != 2:
+                if (track.st == 0):
+                    track.st = dt
+                if data is not None:
+                    parts = wave_parts.get(track)
+                    if parts is None:
+                        parts = wave_parts[track] = []
+                    parts.append(bytes(data) if copy else data)
+
+        self.finalize_tracks(wave_parts, tracks)
+
+    # Converts every track that is still list-backed to arrays and gathers its stats from the
+    # decoded samples (see vital_stats.add_raw for ADC tracks).
+    def finalize_tracks(self, wave_parts, tracks=None):
+        tracks = self.track if tracks is None else tracks
+        for itrack in tracks:
+            t_track = tracks[itrack]
+            if not isinstance(t_track.dt, list):
+                continue
+            if t_track.rec_type == 1 or t_track.rec_type == 2 or t_track.rec_type == 6:
+                t_track.dt = np.array(t_track.dt, dtype=np.float64)
+                if t_track.rec_type == 2:
+                    t_track.v_number = np.array(t_track.v_number, dtype=np.float32)
+                    t_track.raw = np.array(t_track.raw, dtype=np.float32)
+                    samples = t_track.v_number
+                else:
+                    t_track.v_number = np.array(t_track.v_number, dtype=np.int32)
+                    t_track.raw = decode_wave(t_track, wave_parts.get(t_track, []))
+                    samples = t_track.raw
+                t_track.stats = vital_stats()
+                t_track.stats.update(t_track, t_track.dt, t_track.v_number, samples)
+            elif t_track.stats is None:
+                t_track.stats = vital_stats()
+                t_track.stats.update(t_track, t_track.dt, t_track.v_number)
+
+    # Decoded tracks are left alone: the metadata seen on the way is parsed into scratch dicts and
+    # only devices and tracks that are not known yet are added.
+    def build_index(self, save=True, spacing=1 << 20):
+        self.index = vital_index()
+        table = {}
+        tracks = {}
+        devices = {}
+        for type, buf, pos, end, offset in self.iter_packets(checkpoints=self.index.checkpoints, spacing=spacing):
+            if (type == 1):  # SAVE_REC
+                dt, tid = struct.unpack_from('<dH', buf, pos + 2)
+                track = tracks.get(tid)
+                number = 1
+                if track is not None and (track.rec_type == 1 or track.rec_type == 6):
+                    number = struct.unpack_from('<L', buf, pos + 12)[0]
+                if tid not in table:
+                    table[tid] = ([], [], [])
+                table[tid][0].append(dt)
+                table[tid][1].append(offset)
+                table[tid][2].append(number)
+            elif (type == 0 or type == 9):  # SAVE_TRKINFO, SAVE_DEVINFO
+                self.index.meta.append(buf[pos - 5:end].tobytes())
+                if type == 0:
+                    self.parse_trkinfo(buf, pos, end, tracks)
+                else:
+                    self.parse_devinfo(buf, pos, end, devices)
+        self.merge_metadata(tracks, devices)
+        for tid in table:
+            self.index.dt[tid] = np.array(table[tid][0], dtype=np.float64)
+            self.index.offset[tid] = np.array(table[tid][1], dtype=np.int64)
+            self.index.number[tid] = np.array(table[tid][2], dtype=np.int64)
+        stat = os.stat(self.filename)
+        self.index.source = (stat.st_size, stat.st_mtime_ns)
+        if save:
+            self.index.save(self.filename + '.idx.npz')
+        return self.index
+
+    def build_pyramids(self, save=True):
+        for itrack in self.track:
+            t_track = self.track[itrack]
+            if (t_track.rec_type == 1 or t_track.rec_type == 6) and not isinstance(t_track.raw, list):
+                t_track.get_pyramid()
+        if save:
+            self.save_pyramids()
+
+    def save_pyramids(self, filename=None):
+        stat = os.stat(self.filename)
+        arrays = {'source': np.array((stat.st_size, stat.st_mtime_ns), dtype=np.int64)}
         for itrack in self.track:
-            if self.track[itrack].rec_type == 1 or self.track[itrack].rec_type == 2:
-                self.track[itrack].dt = np.array(self.track[itrack].dt, dtype=np.float64)
-                self.track[itrack].v_wave = np.array(self.track[itrack].v_wave, dtype=np.float32)
-                if self.track[itrack].rec_type == 1:
-                    self.track[itrack].v_number = np.array(self.track[itrack].v_number, dtype=np.int32)
-                elif self.track[itrack].rec_type == 2:
-                    self.track[itrack].v_number = np.array(self.track[itrack].v_number, dtype=np.float32)
+            pyramid = self.track[itrack].pyramid
+            if pyramid is None:
+                continue
+            arrays['dt_%d' % itrack] = np.asarray(pyramid.segments.dt, dtype=np.float64)
+            arrays['number_%d' % itrack] = np.asarray(self.track[itrack].v_number, dtype=np.int64)
+            for level in range(len(pyramid.vmin)):
+                arrays['min_%d_%d' % (itrack, level)] = pyramid.vmin[level]
+                arrays['max_%d_%d' % (itrack, level)] = pyramid.vmax[level]
+                arrays['mean_%d_%d' % (itrack, level)] = pyramid.vmean[level]
+        with open(filename or self.filename + '.pyr.npz', 'wb') as f:
+            np.savez(f, **arrays)
+
+    # Attaches the sidecar pyramids to the tracks, which must already be known (read_metadata or
+    # open_index); returns False when the file is missing or stale.
+    def open_pyramids(self, filename=None):
+        filename = filename or self.filename + '.pyr.npz'
+        if not os.path.exists(filename):
+            return False
+        stat = os.stat(self.filename)
+        with np.load(filename) as data:
+            if tuple(int(v) for v in data['source']) != (stat.st_size, stat.st_mtime_ns):
+                return False
+            for key in data.files:
+                if not key.startswith('dt_') or int(key[3:]) not in self.track:
+                    continue
+                tid = int(key[3:])
+                pyramid = vital_pyramid()
+                pyramid.segments = vital_segments(data[key], data['number_%d' % tid], self.track[tid].srate)
+                pyramid.count = int(pyramid.segments.offsets[-1])
+                level = 0
+                while 'min_%d_%d' % (tid, level) in data.files:
+                    pyramid.vmin.append(data['min_%d_%d' % (tid, level)])
+                    pyramid.vmax.append(data['max_%d_%d' % (tid, level)])
+                    pyramid.vmean.append(data['mean_%d_%d' % (tid, level)])
+                    level += 1
+                self.track[tid].pyramid = pyramid
+        return True
+
+    # Loads the sidecar index (rebuilding it when missing or stale) and the device/track metadata.
+    def open_index(self):
+        stat = os.stat(self.filename)
+        index = vital_index.load(self.filename + '.idx.npz')
+        if index is None or index.source != (stat.st_size, stat.st_mtime_ns):
+            return self.build_index()
+        self.index = index
+        tracks = {}
+        devices = {}
+        for type, buf, pos, end, offset in iter_buffer_packets(b''.join(index.meta)):
+            if type == 0:
+                self.parse_trkinfo(buf, pos, end, tracks)
+            else:
+                self.parse_devinfo(buf, pos, end, devices)
+        self.merge_metadata(tracks, devices)
+        return index
+
+    # Adds the devices and tracks that are not known yet; tracks already on the reader keep their samples.
+    def merge_metadata(self, tracks, devices):
+        for tid in tracks:
+            self.track.setdefault(tid, tracks[tid])
+        for did in devices:
+            self.device.setdefault(did, devices[did])
+
+    # Decodes the records of the selected tracks overlapping [t_start, t_end) (UTC seconds) into
+    # copies of the tracks, inflating only from the closest restart point to the last matching
+    # packet, and returns them as {tid: track}. The reader's own tracks are not modified; tracks
+    # that are already decoded are returned as they are. previous also keeps the last record
+    # before t_start of number tracks.
+    def load_interval(self, tracks, t_start, t_end, previous=False):
+        offsets = []
+        loaded = {}
+        for tid in self.track:
+            if not self.is_selected(tid, tracks):
+                continue
+            t_track = self.track[tid]
+            if len(t_track.dt) or tid not in self.index.dt:
+                loaded[tid] = t_track
+                continue
+            dt = self.index.dt[tid]
+            if (t_track.rec_type == 1 or t_track.rec_type == 6) and t_track.srate > 0:
+                mask = (dt < t_end) & (dt + self.index.number[tid] / t_track.srate > t_start)
+            else:
+                mask = (dt >= t_start) & (dt < t_end)
+                if previous and t_track.rec_type == 2:
+                    last = np.searchsorted(dt, t_start) - 1
+                    if last >= 0:
+                        mask[last] = True
+            offsets.append(self.index.offset[tid][mask])
+            loaded[tid] = t_track.copy_info()
+        offsets = np.sort(np.concatenate(offsets)) if offsets else np.array([], dtype=np.int64)
+        records = self.iter_records(packets=self.iter_index_packets(offsets))
+        self.collect(((loaded[track.tid], dt, number, data) for track, dt, number, data in records), loaded)
+        return loaded
+
+    def iter_index_packets(self, offsets):
+        if len(offsets) == 0:
+            return
+        wanted = set(offsets.tolist())
+        last = int(offsets[-1])
+        start = self.index.restart_point(int(offsets[0]))
+        for packet in self.iter_packets(offset=int(offsets[0]), start=start):
+            if packet[4] > last:
+                break
+            if packet[4] in wanted:
+                yield packet
 
     def check_validity(self):
         r = []
@@ -449,25 +1797,56 @@ class vital_reader(object):
                 device = self.device[self.track[itrack].did]
                 if self.track[itrack].rec_type == 2:
                     recoding_type = 'Number'
-                    valid = 0
-                    for i in range(len(self.track[itrack].v_number)):
-                        if self.track[itrack].v_number[i] >= self.track[itrack].minval and self.track[itrack].v_number[
-                            i] <= self.track[itrack].maxval:
-                            valid = valid + 1
-                    result_track = [device.devname, device.port, self.track[itrack].name, recoding_type, valid,
-                                    len(self.track[itrack].v_number), self.track[itrack].srate]
-                    #                result_track.extend([self.track[itrack].minval, self.track[itrack].maxval])
-                    r.append(result_track)
                 elif self.track[itrack].rec_type == 1 or self.track[itrack].rec_type == 5 or self.track[
                     itrack].rec_type == 6:
                     recoding_type = 'Wave'
-                    valid = 0
-                    for i in range(len(self.track[itrack].v_wave)):
-                        if self.track[itrack].v_wave[i] >= self.track[itrack].minval and self.track[itrack].v_wave[i] <= \
-                                self.track[itrack].maxval:
-                            valid = valid + 1
-                    result_track = [device.devname, device.port, self.track[itrack].name, recoding_type, valid,
-                                    len(self.track[itrack].v_wave), self.track[itrack].srate]
-                    #                result_track.extend([self.track[itrack].minval, self.track[itrack].maxval])
-                    r.append(result_track)
-        return r
\ No newline at end of file
+                else:
+                    continue
+                stats = self.track_stats(itrack)
+                # string tracks have no samples to check
+                valid, total = (0, 0) if self.track[itrack].rec_type == 5 else (stats.valid, stats.count)
+                result_track = [device.devname, device.port, self.track[itrack].name, recoding_type, valid,
+                                total, self.track[itrack].srate]
+                #                result_track.extend([self.track[itrack].minval, self.track[itrack].maxval])
+                r.append(result_track)
+        return r
+
+    # Stats of a track; the decoder, the cache and follow() fill them, so this computes them only
+    # for tracks whose arrays were set some other way.
+    def track_stats(self, tid):
+        t_track = self.track[tid]
+        if t_track.stats is None:
+            t_track.stats = vital_stats()
+            if t_track.rec_type == 2:
+                t_track.stats.update(t_track, t_track.dt, t_track.v_number, np.asarray(t_track.v_number, dtype=np.float32))
+            elif t_track.rec_type == 5:
+                t_track.stats.update(t_track, t_track.dt, t_track.v_number)
+            else:
+                t_track.stats.update(t_track, t_track.dt, t_track.v_number, np.asarray(t_track.raw))
+        return t_track.stats
+
+    def qc_report(self):
+        r = []
+        r.append(['Device', 'Port', 'Track', 'Unit', 'Type', 'SamplingRate', 'Records', 'Samples', 'Valid', 'NaN',
+                  'Min', 'Max', 'Mean', 'Std', 'Gaps', 'Duration', 'Start', 'End'])
+        for itrack in self.track:
+            t_track = self.track[itrack]
+            device = self.device.get(t_track.did)
+            stats = self.track_stats(itrack)
+            r.append([device.devname if device else '', device.port if device else '', t_track.name, t_track.unit,
+                      {1: 'Wave', 2: 'Number', 5: 'String', 6: 'Wave'}.get(t_track.rec_type, t_track.rec_type),
+                      t_track.srate, stats.records, stats.count, stats.valid, stats.nan, stats.min, stats.max,
+                      stats.mean, float(stats.std), stats.gaps, stats.duration, stats.first_dt, stats.last_dt])
+        return r
+
+    # Writes qc_report as CSV, or as a JSON list of objects when filename ends with .json.
+    def write_qc_report(self, filename):
+        rows = [[v.decode('latin-1') if isinstance(v, bytes) else v for v in row] for row in self.qc_report()]
+        if filename.endswith('.json'):
+            with open(filename, 'w') as f:
+                json.dump([{key: None if isinstance(v, float) and np.isnan(v) else v for key, v in zip(rows[0], row)}
+                           for row in rows[1:]], f, indent=1)
+            return
+        with open(filename, 'w', newline='') as csvfile:
+            csv_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting = csv.QUOTE_MINIMAL)
+            csv_writer.writerows(rows)
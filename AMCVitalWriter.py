@@ -0,0 +1,117 @@
+import sys
+import gzip
+import struct
+import argparse
+import numpy as np
+
+# Writes .vital files packet by packet: the header, SAVE_DEVINFO, SAVE_TRKINFO, SAVE_REC (wave
+# rec_fmt 1/5/6, number, string) and SAVE_CMD, in the layout vital_reader parses.
+class vital_writer(object):
+    def __init__(self, filename, compress=True, compresslevel=1, tzbias=-540, inst_id=0, prog_ver=0):
+        self.filename = filename
+        self.file = gzip.open(filename, 'wb', compresslevel=compresslevel) if compress else open(filename, 'wb')
+        self.track = {}
+        header = struct.pack('<hLL', tzbias, inst_id, prog_ver)
+        self.file.write(b'VITA' + struct.pack('<LH', 3, len(header)) + header)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_packet(self, type, payload):
+        self.file.write(struct.pack('<BL', type, len(payload)) + payload)
+
+    def write_device(self, did, typename, devname='', port=''):
+        self.write_packet(9, struct.pack('<L', did) + string(typename) + string(devname) + string(port))
+
+    def write_track(self, tid, name, rec_type=1, rec_fmt=1, unit='', minval=0.0, maxval=0.0, srate=0.0,
+                    adc_gain=1.0, adc_offset=0.0, did=0, color=0xffff0000, mon_type=0):
+        self.track[tid] = (rec_type, rec_fmt)
+        self.write_packet(0, struct.pack('<HBB', tid, rec_type, rec_fmt) + string(name) + string(unit) +
+                          struct.pack('<ffLfddBL', minval, maxval, color, srate, adc_gain, adc_offset, mon_type, did))
+
+    # samples are the values as stored: floats for rec_fmt 1 and raw ADC integers for rec_fmt 5/6.
+    def write_wave(self, tid, dt, samples):
+        dtype = '<f4' if self.track[tid][1] == 1 else '<i2'
+        samples = np.asarray(samples).astype(dtype)
+        self.write_packet(1, struct.pack('<HdHL', 10, dt, tid, len(samples)) + samples.tobytes())
+
+    def write_number(self, tid, dt, value):
+        self.write_packet(1, struct.pack('<HdHf', 10, dt, tid, value))
+
+    def write_string(self, tid, dt, value):
+        self.write_packet(1, struct.pack('<HdHL', 10, dt, tid, 0) + string(value))
+
+    def write_cmd_order(self, tids):
+        self.write_packet(6, struct.pack('<BH', 5, len(tids)) + struct.pack('<%dH' % len(tids), *tids))
+
+def string(value):
+    value = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('<L', len(value)) + value
+
+# The mix written by synthesize(): device type, track name, rec_type, rec_fmt, unit, minval, maxval,
+# srate, adc_gain, adc_offset. Waves are a sine plus noise spanning about twice [minval, maxval].
+default_tracks = [
+    ('DI-1120', 'VOLT', 1, 1, 'V', -1.0, 1.0, 500.0, 1.0, 0.0),
+    ('Primus', 'AWP', 1, 5, 'cmH2O', -10.0, 40.0, 62.5, 0.01, -5.0),
+    ('Primus', 'CO2', 2, 1, 'mmHg', 0.0, 60.0, 0.0, 1.0, 0.0),
+    ('', 'EVENT', 5, 1, '', 0.0, 0.0, 0.0, 1.0, 0.0),
+    ('DI-1120', 'PLETH', 1, 6, '', 0.0, 100.0, 100.0, 0.5, 1.0),
+]
+
+# Writes a synthetic recording of duration seconds starting at t0 (UTC): one record per track every
+# record_seconds (numbers once per record, strings every event_seconds), nothing inside the gaps
+# ((start, length) in seconds from t0), and a CMD_ORDER packet after the metadata. Sample counts per
+# record follow the sampling rate exactly, so a rate like 62.5 Hz alternates 62 and 63 samples.
+def synthesize(filename, duration=60, tracks=None, gaps=(), t0=1524611032.0, record_seconds=1.0,
+               event_seconds=20, seed=0, compress=True, compresslevel=1):
+    tracks = default_tracks if tracks is None else tracks
+    rnd = np.random.default_rng(seed)
+    devices = {}
+    with vital_writer(filename, compress, compresslevel) as writer:
+        for spec in tracks:
+            if spec[0] and spec[0] not in devices:
+                devices[spec[0]] = len(devices) + 1
+                writer.write_device(devices[spec[0]], spec[0], spec[0].split('-')[0], 'COM%d' % devices[spec[0]])
+        for tid, (typename, name, rec_type, rec_fmt, unit, minval, maxval, srate, adc_gain, adc_offset) in enumerate(tracks, 1):
+            writer.write_track(tid, name, rec_type, rec_fmt, unit, minval, maxval, srate, adc_gain, adc_offset, devices.get(typename, 0))
+        writer.write_cmd_order(list(range(1, len(tracks) + 1)))
+        for k in range(int(np.ceil(duration / record_seconds))):
+            t = k * record_seconds
+            if any(start <= t < start + length for start, length in gaps):
+                continue
+            for tid, (typename, name, rec_type, rec_fmt, unit, minval, maxval, srate, adc_gain, adc_offset) in enumerate(tracks, 1):
+                center = (minval + maxval) / 2
+                amplitude = (maxval - minval) or 1.0
+                if rec_type == 1:
+                    first = int(round(t * srate))
+                    n = int(round((t + record_seconds) * srate)) - first
+                    i = np.arange(first, first + n)
+                    values = center + amplitude * (np.sin(2 * np.pi * i / srate) + 0.25 * rnd.standard_normal(n))
+                    if rec_fmt != 1:
+                        values = np.clip(np.round((values - adc_offset) / adc_gain), -32768, 32767)
+                    writer.write_wave(tid, t0 + first / srate, values)
+                elif rec_type == 2:
+                    writer.write_number(tid, t0 + t + 0.3 * record_seconds, center + amplitude * (rnd.random() - 0.5) * 1.5)
+                elif rec_type == 5 and k % max(int(event_seconds / record_seconds), 1) == 0:
+                    writer.write_string(tid, t0 + t + 0.5 * record_seconds, 'event %d' % k)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic .vital file.')
+    parser.add_argument('file')
+    parser.add_argument('-d', '--duration', type=float, default=60, help='seconds (default 60)')
+    parser.add_argument('-g', '--gap', action='append', default=[], help='START:LENGTH in seconds; may be repeated')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--raw', action='store_true', help='write without gzip compression')
+    args = parser.parse_args(argv)
+    synthesize(args.file, args.duration, gaps=[tuple(float(v) for v in g.split(':')) for g in args.gap],
+               seed=args.seed, compress=not args.raw)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())